@@ -0,0 +1,336 @@
+#  Copyright (c) Meta Platforms, Inc. and affiliates.
+#  All rights reserved.
+#  This source code is licensed under the license found in the
+#  LICENSE file in the root directory of this source tree.
+
+import argparse
+import av
+import cv2
+import io
+import json
+import numpy as np
+import os
+import platform
+import shutil
+import tempfile
+import time
+from cache import asset_cache
+from combinator import AlphaEngine, MarginCombinator
+from contextlib import redirect_stdout
+from os.path import join
+from sink import Sink
+from source import Blending, SingleMediaSource, ImageSlideshowSource, next_frame_into
+from strobe import StrobeSource
+import videogen
+
+# Bumped whenever stages or assets change, so that results of different suites are not compared
+SUITE_VERSION = 3
+
+DEFAULT_RESOLUTIONS = "640x360,1280x720,1920x1080"
+
+def generate_assets(directory, resolution, seed=0, clip_frames=60):
+    """
+    Writes a synthetic set of assets at the given resolution: a background image, an alpha PNG logo,
+    a chroma key clip, a short video, product images, and a template directory rendering all of them.
+
+    Parameters:
+        directory (str): The directory the assets are written into. Created if needed.
+        resolution (tuple): The (width, height) of the generated video assets.
+        seed (int): The seed of the random content, so that runs render the same pixels. Default is 0.
+        clip_frames (int): The amount of frames of the generated videos. Default is 60.
+
+    Returns:
+        dict: The path of every asset, indexed by name.
+    """
+    rng = np.random.default_rng(seed)
+    width, height = resolution
+    template = join(directory, 'template')
+    products = join(directory, 'products')
+    os.makedirs(template, exist_ok=True)
+    os.makedirs(join(directory, 'output'), exist_ok=True)
+
+    # Smooth gradients with noise, so that encoders and resizes do real work
+    y, x = np.mgrid[0:height, 0:width]
+    background = np.dstack(((x * 255 // max(1, width - 1)), (y * 255 // max(1, height - 1)), ((x + y) % 256))).astype(np.uint8)
+    background = cv2.add(background, rng.integers(0, 32, background.shape, dtype=np.uint8))
+    cv2.imwrite(join(template, 'background.jpg'), background)
+
+    size = max(16, min(width, height) // 3)
+    logo = np.zeros((size, size, 4), np.uint8)
+    cv2.circle(logo, (size // 2, size // 2), size // 2 - 1, (40, 90, 220, 255), -1)
+    logo[:, :, 3] = cv2.GaussianBlur(logo[:, :, 3], (0, 0), max(1, size / 20))
+    cv2.imwrite(join(template, 'logo.png'), logo)
+
+    clip = join(template, 'clip.mp4')
+    chroma = join(template, 'chroma.mp4')
+    _write_video(clip, resolution, clip_frames, lambda i: np.roll(background, i * 8, axis=1))
+    def chroma_frame(i):
+        frame = np.zeros((size, size, 3), np.uint8)
+        frame[:] = (0, 255, 0)
+        offset = (i * 4) % (size // 2)
+        cv2.rectangle(frame, (offset, offset), (offset + size // 2, offset + size // 2), (200, 60, 30), -1)
+        return frame
+    _write_video(chroma, (size, size), clip_frames, chroma_frame)
+
+    product_paths = []
+    for p in range(2):
+        product = join(products, f"product{p}")
+        os.makedirs(product, exist_ok=True)
+        for i in range(3):
+            path = join(product, f"{i}.jpg")
+            cv2.imwrite(path, rng.integers(0, 256, (max(16, height // 2), max(16, width // 2), 3), dtype=np.uint8))
+            if p == 0:
+                product_paths.append(path)
+
+    with open(join(directory, 'template.csv'), 'w') as csv_file:
+        csv_file.write("Phase,Type,Source,Width,Height,H Margin,V Margin,H Alignment,V Alignment,Transparency,Duration,Loop,Effect,Direction,Min Size,Start Size,Speed,Effect Loop,Chroma Key\n")
+        csv_file.write(f"0,OUTPUT,,{width},{height},,,,,,,,,,,,,,\n")
+        csv_file.write("1,GRAPHICS,background.jpg,100%,100%,0,0,LEFT,TOP,Solid,1,yes,none,,,,,,\n")
+        csv_file.write("1,SLIDESHOW,,50%,50%,5%,5%,LEFT,CENTERED,Alpha Blending,1,no,none,,,,,,\n")
+        csv_file.write("1,GRAPHICS,logo.png,30%,30%,5%,5%,RIGHT,BOTTOM,Alpha Blending,1,yes,zoom,in,small,full,fast,yes,\n")
+        csv_file.write("2,GRAPHICS,clip.mp4,100%,100%,0,0,LEFT,TOP,Solid,1,yes,none,,,,,,\n")
+        csv_file.write("2,GRAPHICS,chroma.mp4,30%,30%,0,0,CENTERED,CENTERED,Chroma Keying,1,yes,none,,,,,,#00FF00\n")
+
+    return {
+        "background": join(template, 'background.jpg'),
+        "logo": join(template, 'logo.png'),
+        "clip": clip,
+        "chroma": chroma,
+        "products": product_paths,
+        "target": directory
+    }
+
+def _write_video(path, resolution, frames, frame_at, fps=30):
+    container = av.open(path, mode='w')
+    try:
+        stream = container.add_stream('mpeg4', rate=fps)
+        stream.width, stream.height = resolution
+        stream.pix_fmt = 'yuv420p'
+        for i in range(frames):
+            frame = av.VideoFrame.from_ndarray(np.ascontiguousarray(frame_at(i)), format='bgr24')
+            container.mux(stream.encode(frame))
+        container.mux(stream.encode(None))
+    finally:
+        container.close()
+
+def _time_frames(source, frames):
+    # Returns the seconds taken to pull the given amount of frames
+    start = time.perf_counter()
+    for _ in range(frames):
+        source.next_frame()
+    return time.perf_counter() - start
+
+def _time_blocks(source, frames, batch_size):
+    # Returns the seconds taken to render the given amount of frames into a buffer, as the Sink does, batch_size frames at a time
+    first = source.next_frame()
+    block = np.empty((batch_size,) + first.shape, first.dtype)
+    start = time.perf_counter()
+    done = 0
+    while done < frames:
+        count = min(batch_size, frames - done)
+        if count == 1:
+            next_frame_into(source, block[0])
+        else:
+            source.next_frames(count, out=block[:count])
+        done += count
+    return time.perf_counter() - start
+
+def _time_combine(bg_source, fg_source, alpha_engine, frames):
+    # Only the blending is timed, the canvas is restored between calls
+    combinator = MarginCombinator(bg_source, fg_source, 10, 10, alpha_engine=alpha_engine)
+    bg_image = bg_source.next_frame()
+    canvas = np.empty_like(bg_image)
+    elapsed = 0.0
+    for _ in range(frames):
+        fg_image = fg_source.next_frame()
+        np.copyto(canvas, bg_image)
+        start = time.perf_counter()
+        combinator.combine(canvas, fg_image)
+        elapsed += time.perf_counter() - start
+    return elapsed
+
+def _stages(assets, resolution, frames, directory):
+    """
+    Returns every benchmarked stage as a (name, function) pair, where the function returns the seconds taken and the amount of frames.
+    """
+    width, height = resolution
+    size = (max(16, width // 3), max(16, height // 3))
+
+    def decode():
+        asset_cache.clear()
+        start = time.perf_counter()
+        source = SingleMediaSource(assets["clip"], resolution, disk_cache=False)
+        return time.perf_counter() - start, len(source.frames)
+
+    def decode_skipping():
+        # A third of the frames are shown, the others are decoded without being converted
+        asset_cache.clear()
+        start = time.perf_counter()
+        source = SingleMediaSource(assets["clip"], resolution, target_fps=10, disk_cache=False)
+        return time.perf_counter() - start, source.container.streams.video[0].frames
+
+    def image_load():
+        asset_cache.clear()
+        start = time.perf_counter()
+        SingleMediaSource(assets["background"], resolution)
+        return time.perf_counter() - start, 1
+
+    def video_frames():
+        return _time_frames(SingleMediaSource(assets["clip"], resolution, target_fps=60), frames), frames
+
+    def streaming_frames():
+        return _time_frames(SingleMediaSource(assets["clip"], resolution, target_fps=60, streaming=True), frames), frames
+
+    def slideshow_frames():
+        source = ImageSlideshowSource(assets["products"], (width // 2, height // 2), standby_time=0.25, transition_time=0.25, target_fps=60, blending=Blending.ALPHA)
+        return _time_frames(source, frames), frames
+
+    def strobe_frames():
+        source = StrobeSource(SingleMediaSource(assets["logo"], size, blending=Blending.ALPHA), 0.3, 1, 0.01)
+        return _time_frames(source, frames), frames
+
+    def strobe_video_frames():
+        source = StrobeSource(SingleMediaSource(assets["clip"], size, target_fps=60, blending=Blending.ALPHA), 0.3, 1, 0.01)
+        return _time_frames(source, frames), frames
+
+    def combine(blending, alpha_engine=AlphaEngine.FIXED_POINT):
+        def run():
+            bg_source = SingleMediaSource(assets["background"], resolution)
+            path = assets["chroma"] if blending == Blending.CHROMA_KEYING else assets["logo"]
+            fg_source = SingleMediaSource(path, size, target_fps=60, blending=blending)
+            return _time_combine(bg_source, fg_source, alpha_engine, frames), frames
+        return run
+
+    def template_frames(batch_size):
+        def run():
+            with redirect_stdout(io.StringIO()):
+                video = videogen.Video(assets["target"])
+                controller = video._compose()
+            controller.reset(next(iter(video.products.values())))
+            return _time_blocks(controller, frames, batch_size), frames
+        return run
+
+    def encode(queue_depth):
+        def run():
+            source = SingleMediaSource(assets["clip"], resolution, target_fps=60)
+            sink = Sink(source, target_fps=60, output_video_path=join(directory, 'encode.mp4'), queue_depth=queue_depth, frames=frames)
+            start = time.perf_counter()
+            sink.create_video()
+            return time.perf_counter() - start, frames
+        return run
+
+    def end_to_end():
+        for file in os.listdir(join(assets["target"], 'output')):
+            os.remove(join(assets["target"], 'output', file))
+        with redirect_stdout(io.StringIO()):
+            video = videogen.Video(assets["target"])
+            start = time.perf_counter()
+            video.create(force=True)
+        frame_count = sum(round(phase["duration"] * video.fps) for phase in video.phases.values())
+        return time.perf_counter() - start, frame_count * len(video.products)
+
+    return [
+        ("decode", decode),
+        ("decode.skipping", decode_skipping),
+        ("image_load", image_load),
+        ("next_frame.video", video_frames),
+        ("next_frame.video_streaming", streaming_frames),
+        ("next_frame.slideshow", slideshow_frames),
+        ("next_frame.strobe_static", strobe_frames),
+        ("next_frame.strobe_video", strobe_video_frames),
+        ("combine.solid", combine(None)),
+        ("combine.alpha_fixed_point", combine(Blending.ALPHA)),
+        ("combine.alpha_float", combine(Blending.ALPHA, AlphaEngine.FLOAT)),
+        ("combine.chroma_keying", combine(Blending.CHROMA_KEYING)),
+        ("render.template", template_frames(1)),
+        ("render.template_batched", template_frames(16)),
+        ("encode", encode(0)),
+        ("encode.pipelined", encode(4)),
+        ("end_to_end", end_to_end)
+    ]
+
+def run(resolutions, frames=120, repeat=3, stages=None, seed=0):
+    """
+    Generates the assets and times every stage at every resolution.
+    Each stage runs repeat times, and the fastest run is reported as it is the least disturbed by the rest of the system.
+
+    Parameters:
+        resolutions (list): The (width, height) resolutions to benchmark.
+        frames (int): The amount of frames timed by frame based stages. Default is 120.
+        repeat (int): The amount of runs of every stage. Default is 3.
+        stages (list): The names of the stages to run, or prefixes of them. Default is None, running all of them.
+        seed (int): The seed of the generated assets. Default is 0.
+
+    Returns:
+        dict: The environment and the results of every stage, ready to be written as JSON.
+    """
+    results = []
+    directory = tempfile.mkdtemp(prefix="vtb-benchmark-")
+    try:
+        for resolution in resolutions:
+            target = join(directory, f"{resolution[0]}x{resolution[1]}")
+            assets = generate_assets(target, resolution, seed)
+            for name, stage in _stages(assets, resolution, frames, target):
+                if stages != None and not any(name.startswith(prefix) for prefix in stages):
+                    continue
+                runs = [stage() for _ in range(max(1, repeat))]
+                seconds, count = min(runs)
+                results.append({
+                    "stage": name,
+                    "resolution": f"{resolution[0]}x{resolution[1]}",
+                    "frames": count,
+                    "seconds": seconds,
+                    "runs": [seconds for seconds, _ in runs],
+                    "fps": count / seconds if seconds > 0 else None
+                })
+                print(f"\t{results[-1]['resolution']:>10} {name:<28} {results[-1]['fps'] or 0:10.1f} fps")
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+    return {
+        "suite_version": SUITE_VERSION,
+        "environment": {
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "processor": platform.processor(),
+            "cpu_count": os.cpu_count(),
+            "numpy": np.__version__,
+            "opencv": cv2.__version__,
+            "av": av.__version__
+        },
+        "config": {
+            "frames": frames,
+            "repeat": repeat,
+            "seed": seed
+        },
+        "results": results
+    }
+
+def _parseResolutions(value):
+    resolutions = []
+    for item in value.split(','):
+        width, height = item.lower().strip().split('x')
+        resolutions.append((int(width), int(height)))
+    return resolutions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Times every stage of the rendering pipeline on synthetic assets and writes the results as JSON")
+    parser.add_argument("--resolutions", default=DEFAULT_RESOLUTIONS, help=f"Comma separated WIDTHxHEIGHT resolutions. Default is {DEFAULT_RESOLUTIONS}")
+    parser.add_argument("--frames", type=int, default=120, help="Frames timed by every frame based stage. Default is 120")
+    parser.add_argument("--repeat", type=int, default=3, help="Runs of every stage, the fastest is reported. Default is 3")
+    parser.add_argument("--stages", default=None, help="Comma separated names or prefixes of the stages to run, e.g. combine,encode. Default runs all of them")
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the generated assets. Default is 0")
+    parser.add_argument("--output", default="benchmark.json", help="Path of the JSON results. Default is benchmark.json")
+    args = parser.parse_args()
+
+    print("Benchmarking")
+    report = run(
+            _parseResolutions(args.resolutions),
+            frames=max(1, args.frames),
+            repeat=args.repeat,
+            stages=None if args.stages == None else [stage.strip() for stage in args.stages.split(',')],
+            seed=args.seed)
+    with open(args.output, 'w') as output:
+        json.dump(report, output, indent=2)
+    print(f"Results written to \"{args.output}\"")
@@ -0,0 +1,297 @@
+#  Copyright (c) Meta Platforms, Inc. and affiliates.
+#  All rights reserved.
+#  This source code is licensed under the license found in the
+#  LICENSE file in the root directory of this source tree.
+
+import hashlib
+import numpy as np
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+from tempfile import gettempdir
+
+class AssetCache:
+    """
+    A least recently used cache of decoded assets shared by every Source in the process.
+    Entries are addressed by the content they were decoded from: the file path, its modification time,
+    the resolution it was rescaled to and its pixel format. Cached arrays are read-only as they are shared.
+    """
+
+    def __init__(self, max_bytes=512 * 1024 * 1024):
+        """
+        The constructor for AssetCache class.
+
+        Parameters:
+            max_bytes (int): The memory budget for all cached assets. Least recently used assets are evicted past it. Default is 512MB.
+        """
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.RLock()
+
+    def key(self, path, resolution, pixel_format):
+        """
+        Builds the key under which an asset decoded from the given file is stored.
+        """
+        path = os.path.abspath(path)
+        return (path, os.stat(path).st_mtime_ns, tuple(resolution), pixel_format)
+
+    def get(self, path, resolution, pixel_format, loader):
+        """
+        Returns the cached asset, calling loader() to decode it on a miss.
+
+        Parameters:
+            path (str): Path to the asset file.
+            resolution (tuple): The resolution the asset is rescaled to.
+            pixel_format (str): The pixel format of the decoded asset.
+            loader (callable): Decodes the asset, returning an array or a list of arrays.
+
+        Returns:
+            The decoded asset.
+        """
+        key = self.key(path, resolution, pixel_format)
+        with self.lock:
+            if key in self.entries:
+                self.hits += 1
+                self.entries.move_to_end(key)
+                return self.entries[key][0]
+            self.misses += 1
+
+        value = loader()
+        self.put(key, value)
+        return value
+
+    def put(self, key, value):
+        """
+        Stores an asset under the given key and evicts older assets until the cache fits in its budget.
+        """
+        for array in (value if isinstance(value, list) else [value]):
+            array.flags.writeable = False
+        size = AssetCache._nbytes(value)
+
+        with self.lock:
+            if key in self.entries:
+                self.size -= self.entries.pop(key)[1]
+            self.entries[key] = (value, size)
+            self.size += size
+            self._evict()
+
+    def resize(self, max_bytes):
+        """
+        Changes the memory budget, evicting assets if it shrinks.
+        """
+        with self.lock:
+            self.max_bytes = max_bytes
+            self._evict()
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+
+    def stats(self):
+        """
+        Returns the cache counters as a dictionary.
+        """
+        with self.lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "entries": len(self.entries),
+                "bytes": self.size,
+                "max_bytes": self.max_bytes
+            }
+
+    def _evict(self):
+        # The most recent entry is kept even if it exceeds the budget on its own
+        while self.size > self.max_bytes and len(self.entries) > 1:
+            _, (_, size) = self.entries.popitem(last=False)
+            self.size -= size
+            self.evictions += 1
+
+    def _nbytes(value):
+        # Memory-mapped assets live in the OS page cache and do not count towards the budget
+        if isinstance(value, np.memmap):
+            return 0
+        return sum(array.nbytes for array in value) if isinstance(value, list) else value.nbytes
+
+
+class FrameStore:
+    """
+    A persistent on-disk store of decoded and rescaled video frames.
+    Frames are saved as a single .npy array per asset and resolution, and memory-mapped read-only when loaded,
+    so later runs and concurrent worker processes share them through the OS page cache instead of decoding again.
+    Entries are keyed by a hash of the asset contents, so changing the asset or the resolution invalidates them.
+    Frames are written to disk as they are decoded, and the least recently used entries are deleted past a byte budget.
+    """
+
+    # Version 2 rescales videos decoded as ARGB, which version 1 stored at their own size
+    VERSION = 2
+
+    # The amount of frames the file grows by when the length of a video is unknown
+    CHUNK_FRAMES = 64
+
+    # Entries used more recently than this many seconds are not evicted, since another process may be about to map them
+    EVICTION_GRACE = 10
+
+    # The names of stored entries and of the files they are written to, other files in the directory are never touched
+    ENTRY_NAME = re.compile(r"[0-9a-f]{40}-\d+x\d+-[a-z0-9-]+-v(\d+)\.npy")
+    TEMP_NAME = re.compile(r"[0-9a-f]{40}-\d+x\d+-[a-z0-9-]+-v\d+\.npy\.\d+\.\d+\.tmp(\.resize)?")
+
+    def __init__(self, directory=None, max_bytes=None):
+        """
+        The constructor for FrameStore class.
+
+        Parameters:
+            directory (str): The directory where frames are stored. Defaults to $VTB_FRAME_CACHE or a folder in the temporary directory.
+            max_bytes (int): The disk budget for all stored frames. Defaults to $VTB_FRAME_CACHE_BYTES or 4GB.
+        """
+        if directory is None:
+            directory = os.environ.get('VTB_FRAME_CACHE', os.path.join(gettempdir(), 'video-template-builder'))
+        if max_bytes is None:
+            max_bytes = int(os.environ.get('VTB_FRAME_CACHE_BYTES', 4 * 1024 * 1024 * 1024))
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hashes = dict()
+        self.lock = threading.Lock()
+
+    def path(self, asset_path, resolution, pixel_format):
+        """
+        Returns the file in which frames decoded from the given asset are stored.
+        """
+        return os.path.join(self.directory,
+                f"{self._hash(asset_path)}-{resolution[0]}x{resolution[1]}-{pixel_format}-v{FrameStore.VERSION}.npy")
+
+    def load(self, asset_path, resolution, pixel_format, decoder, count=None):
+        """
+        Returns the frames of an asset as a read-only memory-mapped array of shape (frames, height, width, channels).
+        On a miss, frames are pulled from decoder() and written to disk as they are decoded, so they are never all held in memory.
+
+        Parameters:
+            asset_path (str): Path to the asset file.
+            resolution (tuple): The resolution the frames are rescaled to.
+            pixel_format (str): The pixel format of the decoded frames.
+            decoder (callable): Returns an iterable over the decoded frames, all with the same shape.
+            count (int): The expected amount of frames, used to size the file up front. Default is None.
+        """
+        path = self.path(asset_path, resolution, pixel_format)
+        try:
+            frames = np.load(path, mmap_mode='r')
+            # The modification time orders entries by last use
+            os.utime(path)
+            return frames
+        except (OSError, ValueError):
+            pass
+
+        frames = iter(decoder())
+        frame = next(frames, None)
+        if frame is None:
+            raise ValueError(f"No frames could be decoded from \"{asset_path}\"")
+        os.makedirs(self.directory, exist_ok=True)
+        capacity = count if count is not None and count > 0 else FrameStore.CHUNK_FRAMES
+        self._evict(capacity * frame.nbytes)
+
+        # Written under a private name and renamed, so concurrent processes never read a partial file
+        temp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        stored = np.lib.format.open_memmap(temp_path, mode='w+', dtype=frame.dtype, shape=(capacity,) + frame.shape)
+        written = 0
+        while frame is not None:
+            if written == len(stored):
+                stored = FrameStore._resize(temp_path, stored, written, 2 * written)
+            stored[written] = frame
+            written += 1
+            frame = next(frames, None)
+        if written < len(stored):
+            # The video had less frames than expected
+            stored = FrameStore._resize(temp_path, stored, written, written)
+        stored.flush()
+        del stored
+        os.replace(temp_path, path)
+
+        return np.load(path, mmap_mode='r')
+
+    def _resize(path, stored, written, capacity):
+        """
+        Returns a memory-mapped array with room for capacity frames, replacing the file at path and keeping its first written frames.
+        """
+        resized_path = f"{path}.resize"
+        resized = np.lib.format.open_memmap(resized_path, mode='w+', dtype=stored.dtype, shape=(capacity,) + stored.shape[1:])
+        for start in range(0, written, FrameStore.CHUNK_FRAMES):
+            end = min(written, start + FrameStore.CHUNK_FRAMES)
+            resized[start:end] = stored[start:end]
+        resized.flush()
+        del stored, resized
+        os.replace(resized_path, path)
+        return np.load(path, mmap_mode='r+')
+
+    def _evict(self, incoming):
+        """
+        Deletes the entries of other versions of the store, and then the least recently used entries
+        until the incoming bytes fit in the budget. Files still mapped by other processes remain readable by them,
+        and entries used within the last EVICTION_GRACE seconds are kept.
+        """
+        entries = []
+        for file in os.listdir(self.directory):
+            path = os.path.join(self.directory, file)
+            match = FrameStore.ENTRY_NAME.fullmatch(file)
+            if match is None:
+                continue
+            try:
+                if int(match.group(1)) != FrameStore.VERSION:
+                    os.remove(path)
+                    continue
+                stat = os.stat(path)
+            except OSError:
+                continue
+            entries.append((stat.st_mtime_ns, stat.st_size, path))
+
+        size = sum(entry[1] for entry in entries) + incoming
+        recent = time.time_ns() - FrameStore.EVICTION_GRACE * 1000000000
+        for mtime, file_size, path in sorted(entries):
+            if size <= self.max_bytes or mtime > recent:
+                break
+            try:
+                os.remove(path)
+                size -= file_size
+            except OSError:
+                pass
+
+    def clear(self):
+        """
+        Removes every stored frame file, including the partial files of interrupted writes.
+        """
+        if not os.path.isdir(self.directory):
+            return
+        for file in os.listdir(self.directory):
+            if FrameStore.ENTRY_NAME.fullmatch(file) or FrameStore.TEMP_NAME.fullmatch(file):
+                os.remove(os.path.join(self.directory, file))
+
+    def _hash(self, asset_path):
+        # Hashes are remembered per file state so each asset is only read once per process
+        stat = os.stat(asset_path)
+        key = (os.path.abspath(asset_path), stat.st_size, stat.st_mtime_ns)
+        with self.lock:
+            if key in self.hashes:
+                return self.hashes[key]
+
+        digest = hashlib.sha1()
+        with open(asset_path, 'rb') as file:
+            for chunk in iter(lambda: file.read(1 << 20), b''):
+                digest.update(chunk)
+
+        with self.lock:
+            self.hashes[key] = digest.hexdigest()
+        return self.hashes[key]
+
+
+# The cache shared by all sources of this process
+asset_cache = AssetCache()
+
+# The on-disk frame store shared by all sources and processes
+frame_store = FrameStore()
@@ -5,14 +5,229 @@
 
 import cv2
 import numpy as np
-from source import Source, Blending
+from enum import Enum
+from source import Source, Blending, intersect_rect, offset_rect, parts_shape, union_rect
+
+class AlphaEngine(Enum):
+    """
+    This class serves as a list of implementations for alpha blending.
+    FIXED_POINT is exact for every 8 bit input and is the default. It is faster than FLOAT on large regions, from about 720p up,
+    and slower on small ones. Both engines round differently, so the engine is not switched by region size, which would mix both roundings in a frame.
+    """
+    FLOAT=0
+    FIXED_POINT=1
+
+def alpha_blend(dst, src, scratch):
+    """
+    Blends a BGRA image over another one in place, using premultiplied alpha in 16 bit fixed point arithmetic.
+    The output alpha channel is the coverage of both images: a + dst_a * (255 - a) / 255.
+
+    Parameters:
+        dst (numpy array): The BGRA uint8 destination, usually a region of the background. Overwritten with the result.
+        src (numpy array): The BGRA uint8 image blended over the destination. Same shape as dst.
+        scratch (dict): Buffers reused between calls. They grow to the largest image blended, and smaller images use views of them.
+    """
+    shape = src.shape
+    if scratch.get("size", 0) < src.size:
+        scratch["size"] = src.size
+        scratch["acc"] = np.empty(src.size, np.uint16)
+        scratch["tmp"] = np.empty(src.size, np.uint16)
+        scratch["inv"] = np.empty(src.size // shape[-1], np.uint16)
+    acc = scratch["acc"][:src.size].reshape(shape)
+    tmp = scratch["tmp"][:src.size].reshape(shape)
+    inv = scratch["inv"][:src.size // shape[-1]].reshape(shape[:-1] + (1,))
+    alpha = src[..., 3:4]
+
+    # dst * (255 - a) + premultiplied src, where the premultiplied alpha is a * 255
+    np.subtract(255, alpha, out=inv, dtype=np.uint16)
+    np.multiply(dst, inv, out=acc, dtype=np.uint16)
+    np.multiply(src, alpha, out=tmp, dtype=np.uint16)
+    np.multiply(alpha, 255, out=tmp[..., 3:4], dtype=np.uint16)
+    acc += tmp
+
+    # Rounded division by 255: (x + 128 + ((x + 128) >> 8)) >> 8, exact for x <= 255 * 255
+    acc += 128
+    np.right_shift(acc, 8, out=tmp)
+    acc += tmp
+    np.right_shift(acc, 8, out=acc)
+    np.copyto(dst, acc, casting='unsafe')
+
+class Blender():
+    """
+    This class blends the frames of a source into a canvas at a given position, using the blending strategy of the source.
+    It holds the buffers and chroma key state of one layer, so it can be reused for every frame of that layer.
+    """
+
+    # The size of the source pixels blended at once by blend_frames
+    CHUNK_BYTES = 256 * 1024
+
+    def __init__(self, source, alpha_engine = AlphaEngine.FIXED_POINT):
+        """
+        The constructor for Blender class.
+
+        Parameters:
+            source (Source): The Source whose frames are blended.
+            alpha_engine (AlphaEngine): The implementation used for alpha blending. Default is FIXED_POINT.
+        """
+        self.source = source
+        self.blending = source.blending_strategy()
+        self.alpha_engine = alpha_engine
+        self.chroma_color = source.chroma_color
+        self.chroma_lut = None
+        self.mask = None
+        self.mask_version = None
+        self.scratch = dict()
+
+    def reset(self):
+        self.mask = None
+
+    def next_parts(self):
+        """
+        Pulls the next frame of the source as parts that are blended separately.
+        Chroma keying filters across the whole image, so it always gets whole frames.
+        """
+        if self.blending == Blending.CHROMA_KEYING:
+            return [(self.source.next_frame(), 0, 0)]
+        return self.source.next_parts()
+
+    def blend_parts(self, canvas, parts, top, left, rect):
+        """
+        Blends a frame given as (image, top, left) parts, with the top left corner of the frame at (top, left).
+        Every pixel is blended on its own outside of chroma keying, so this is the same as blending the assembled frame.
+        """
+        for image, part_top, part_left in parts:
+            self.blend(canvas, image, top + part_top, left + part_left, rect)
+        return canvas
+
+    def blend(self, canvas, image, top, left, rect):
+        """
+        Blends an image of the source into the canvas with its top left corner at (top, left),
+        only within the given (top, left, bottom, right) rectangle of the canvas.
+
+        Parameters:
+            canvas (numpy array): The BGRA destination. Overwritten with the result.
+            image (numpy array): The BGRA frame of the source.
+            top (int): The row of the canvas where the image starts. May be negative.
+            left (int): The column of the canvas where the image starts. May be negative.
+            rect (tuple): The area of the canvas to update, as (top, left, bottom, right).
+
+        Returns:
+            numpy array: The canvas.
+        """
+        # Boundary tests, the image is clipped to the rectangle
+        canvas_rect = intersect_rect(rect, (top, left, top + image.shape[0], left + image.shape[1]))
+        if canvas_rect is None:
+            return canvas
+
+        image_rect = offset_rect(canvas_rect, -top, -left)
+        bg = canvas[canvas_rect[0]:canvas_rect[2], canvas_rect[1]:canvas_rect[3]]
+        fg = image[image_rect[0]:image_rect[2], image_rect[1]:image_rect[3]]
+
+        if self.blending == Blending.ALPHA and self.alpha_engine == AlphaEngine.FIXED_POINT:
+            alpha_blend(bg, fg, self.scratch)
+        elif self.blending == Blending.ALPHA:
+            fg_alpha = fg[:,:,3]
+
+            bg_float = bg.astype(float)
+            fg_alpha = fg_alpha.astype(float)/256
+            fg_float = fg.astype(float)
+
+            for l in range(3):
+                fg_float[:,:,l] = cv2.multiply(fg_alpha, fg_float[:,:,l])
+                bg_float[:,:,l] = cv2.multiply(1 - fg_alpha, bg_float[:,:,l])
+
+            fg_float = fg_float.astype('uint8')
+            bg_float = bg_float.astype('uint8')
+
+            bg[:] = cv2.add(bg_float, fg_float)
+        elif self.blending == Blending.CHROMA_KEYING:
+            mask = self._chroma_mask(image, self.source.frame_version())[image_rect[0]:image_rect[2], image_rect[1]:image_rect[3]]
+            np.copyto(bg, fg, where=mask)
+        else:
+            bg[:] = fg
+        return canvas
+
+    def blend_frames(self, canvas, images, top, left):
+        """
+        Blends a block of frames of the source into a block of canvases of the same length, frame by frame,
+        with the top left corner of every frame at (top, left).
+        Copies and fixed point alpha blending are applied to the whole block at once, other strategies frame by frame.
+
+        Parameters:
+            canvas (numpy array): The BGRA destination, with shape (n, height, width, 4). Overwritten with the result.
+            images (numpy array): The BGRA frames of the source, with shape (n, image height, image width, 4).
+            top (int): The row of the canvas where the frames start. May be negative.
+            left (int): The column of the canvas where the frames start. May be negative.
+
+        Returns:
+            numpy array: The canvas.
+        """
+        rect = (0, 0, canvas.shape[1], canvas.shape[2])
+        canvas_rect = intersect_rect(rect, (top, left, top + images.shape[1], left + images.shape[2]))
+        if canvas_rect is None:
+            return canvas
+
+        image_rect = offset_rect(canvas_rect, -top, -left)
+        bg = canvas[:, canvas_rect[0]:canvas_rect[2], canvas_rect[1]:canvas_rect[3]]
+        fg = images[:, image_rect[0]:image_rect[2], image_rect[1]:image_rect[3]]
+
+        if self.blending == Blending.ALPHA and self.alpha_engine == AlphaEngine.FIXED_POINT:
+            # Frames are blended in chunks whose 16 bit intermediates stay small enough for the CPU caches
+            chunk = max(1, Blender.CHUNK_BYTES // max(1, fg[0].nbytes))
+            for i in range(0, len(canvas), chunk):
+                alpha_blend(bg[i:i + chunk], fg[i:i + chunk], self.scratch)
+        elif self.blending == Blending.CHROMA_KEYING:
+            # The version only identifies the last frame of the block, unless the source repeats the same frame
+            version = self.source.frame_version() if self.source.is_static() else None
+            for i in range(len(canvas)):
+                mask = self._chroma_mask(images[i], version)[image_rect[0]:image_rect[2], image_rect[1]:image_rect[3]]
+                np.copyto(bg[i], fg[i], where=mask)
+        elif self.blending == Blending.ALPHA:
+            for i in range(len(canvas)):
+                self.blend(canvas[i], images[i], top, left, rect)
+        else:
+            bg[:] = fg
+        return canvas
+
+    def _chroma_mask(self, image, version):
+        """
+        Returns a boolean mask of the pixels of the image that are not part of the chroma key.
+        The key saturation is detected once, and masks are only computed again when the given version of the source changes,
+        or on every call if it is None.
+        The mask is computed over the whole image so that filtering near clipping edges is unaffected.
+        """
+        if self.mask is not None and version is not None and version == self.mask_version:
+            return self.mask
+
+        hsv = cv2.cvtColor(image, cv2.COLOR_BGR2HSV)
+        s = hsv[:,:,1]
+
+        if self.chroma_lut is None:
+            if self.chroma_color is None:
+                # The most common saturation is taken as the key
+                self.chroma_color = int(np.argmax(np.bincount(s.ravel(), minlength=256)))
+
+            # Maps saturations within the margin of the key to 0 and everything else to 255
+            margin = 10
+            self.chroma_lut = np.full(256, 255, np.uint8)
+            self.chroma_lut[max(0, self.chroma_color - margin):self.chroma_color + margin + 1] = 0
+
+        # Eroding the inverted key is the same as inverting the dilated key
+        kernel = np.ones((3,3), np.uint8)
+        mask = cv2.LUT(s, self.chroma_lut)
+        mask = cv2.erode(mask, kernel, iterations = 1)
+        mask = cv2.medianBlur(mask, 5)
+
+        self.mask = (mask == 255)[:,:,np.newaxis]
+        self.mask_version = version
+        return self.mask
 
 class MarginCombinator(Source):
     """
     This class handles the combination of two sources (background and product) with specified margins.
     """
 
-    def __init__(self, bg_source, fg_source, margin_top = 0, margin_left = 0):
+    def __init__(self, bg_source, fg_source, margin_top = 0, margin_left = 0, alpha_engine = AlphaEngine.FIXED_POINT):
         """
         The constructor for MarginCombinator class.
 
@@ -21,6 +236,7 @@ class MarginCombinator(Source):
             fg_source (Source): The Source from which the product image is pulled.
             margin_top (int): The top margin. Default is 0.
             margin_left (int): The left margin. Default is 0.
+            alpha_engine (AlphaEngine): The implementation used for alpha blending. FLOAT is the original floating point path, faster on small regions but less exact, see AlphaEngine. Default is FIXED_POINT.
 
         Raises:
             ValueError: If the margin would exceed the size of the background image.
@@ -30,10 +246,33 @@ class MarginCombinator(Source):
         self.margin_top = margin_top
         self.margin_left = margin_left
         self.blending = self.fg_source.blending_strategy()
+        self.alpha_engine = alpha_engine
+        self.chroma_color = self.fg_source.chroma_color
+        self.blender = Blender(fg_source, alpha_engine)
+        self.frame = None
+        self.block = None
+        self.bg_version = None
+        self.fg_version = None
+
+    def is_static(self):
+        return self.bg_source.is_static() and self.fg_source.is_static()
+
+    def children(self):
+        return [self.bg_source, self.fg_source]
 
     def reset(self, products):
         self.bg_source.reset(products)
         self.fg_source.reset(products)
+        self.frame = None
+        self.blender.reset()
+
+    def seek(self, index):
+        self.bg_source.seek(index)
+        self.fg_source.seek(index)
+        # Static combinations do not depend on the frame index
+        if not self.is_static():
+            self.frame = None
+        self.blender.reset()
 
     def combine(self, bg_image, fg_image):
         """
@@ -46,85 +285,77 @@ class MarginCombinator(Source):
         Returns:
             numpy array: The combined image.
         """
-        bg_shape = bg_image.shape
-        fg_shape = fg_image.shape
-
-        # Early boundary tests if image is completely out of frame
-        if self.margin_left + fg_shape[0] < 0 or self.margin_left > bg_shape[0] or self.margin_top + fg_shape[1] < 0 or self.margin_top > bg_shape[1]:
-            return bg_image
-
-        xsize = fg_shape[0]
-        ysize = fg_shape[1]
-        ymargin = self.margin_left
-        xmargin = self.margin_top
-        xoffset = 0
-        yoffset = 0
-
-        # Lower than 0 boundary tests
-        if xmargin < 0:
-            xsize += xmargin
-            xoffset = -xmargin
-            xmargin = 0
-        if ymargin < 0:
-            ysize += ymargin
-            yoffset = -ymargin
-            ymargin = 0
-
-        # Bigger than size boundary tests
-        xsize = min(bg_shape[0] - xmargin, xsize)
-        ysize = min(bg_shape[1] - ymargin, ysize)
-
-        bg_start = (xmargin, ymargin)
-        bg_end = (xmargin + xsize, ymargin + ysize)
-        fg_start = (xoffset, yoffset)
-        fg_end = (xoffset + xsize, yoffset + ysize)
-
-        if self.blending == Blending.ALPHA:
-            fg_image = fg_image[fg_start[0]:fg_end[0],fg_start[1]:fg_end[1]]
-            fg_alpha = fg_image[:,:,3]
-
-            bg = bg_image[bg_start[0]:bg_end[0], bg_start[1]:bg_end[1]]
-            bg = bg.astype(float)
-
-            fg_alpha = fg_alpha.astype(float)/256
-            fg = fg_image.astype(float)
+        return self._combine_region(bg_image, fg_image, (0, 0, bg_image.shape[0], bg_image.shape[1]))
 
-            for l in range(3):
-                fg[:,:,l] = cv2.multiply(fg_alpha, fg[:,:,l])
-                bg[:,:,l] = cv2.multiply(1 - fg_alpha, bg[:,:,l])
+    def _combine_region(self, bg_image, fg_image, rect):
+        """
+        Combines the product image into the background image, only within the given (top, left, bottom, right) rectangle of the background.
+        """
+        return self.blender.blend(bg_image, fg_image, self.margin_top, self.margin_left, rect)
 
+    def next_frame(self, out=None):
+        """
+        Combines the next frames of both sources into a canvas retained between frames.
+        Static combinations are composed only once, and otherwise only the areas where either source changed are combined again.
+        """
+        if self.frame is not None and self.is_static():
+            return Source._write(self.frame, out)
 
-            fg = fg.astype('uint8')
-            bg = bg.astype('uint8')
+        bg_image = self.bg_source.next_frame()
+        fg_parts = self.blender.next_parts()
+        fg_shape = parts_shape(fg_parts)
+        bg_version = self.bg_source.frame_version()
+        fg_version = self.fg_source.frame_version()
 
-            bg_image[bg_start[0]:bg_end[0], bg_start[1]:bg_end[1]] = cv2.add(bg, fg)
-        elif self.blending == Blending.CHROMA_KEYING:
-            hsv = cv2.cvtColor(fg_image, cv2.COLOR_BGR2HSV)
-            h,s,v = cv2.split(hsv)
+        full = (0, 0, bg_image.shape[0], bg_image.shape[1])
+        if self.frame is None or self.frame.shape != bg_image.shape:
+            self.frame = np.empty_like(bg_image)
+            dirty = full
+        else:
+            dirty = union_rect(
+                Source._changed_area(self.bg_source, bg_version, self.bg_version, bg_image.shape),
+                offset_rect(
+                    Source._changed_area(self.fg_source, fg_version, self.fg_version, fg_shape),
+                    self.margin_top, self.margin_left))
+            dirty = intersect_rect(dirty, full)
 
-            unique_colors, counts = np.unique(s, return_counts=True)
+        self.bg_version = bg_version
+        self.fg_version = fg_version
+        if dirty is None:
+            return Source._write(self.frame, out)
 
-            chroma_color = None
-            most_common = -1
-            for a in range(len(unique_colors)):
-                if counts[a] > most_common:
-                    most_common = counts[a]
-                    chroma_color = int(unique_colors[a])
+        self.frame[dirty[0]:dirty[2], dirty[1]:dirty[3]] = bg_image[dirty[0]:dirty[2], dirty[1]:dirty[3]]
+        self.blender.blend_parts(self.frame, fg_parts, self.margin_top, self.margin_left, dirty)
+        self._changed(None if dirty == full else dirty)
+        return Source._write(self.frame, out)
 
-            margin = 10
-            mask = cv2.inRange(s, chroma_color - margin, chroma_color + margin)
+    def next_frames(self, n, out=None):
+        """
+        Combines the next n frames of both sources as blocks.
+        If neither source changed since the last frame, the retained canvas is repeated without combining them again.
+        """
+        if self.frame is not None and self.is_static():
+            return Source._write_frames(self.frame, n, out)
 
-            kernel = np.ones((3,3), np.uint8)
-            mask = cv2.dilate(mask, kernel, iterations = 1)
-            mask = cv2.medianBlur(mask, 5)
-            mask = cv2.bitwise_not(mask)
+        bg_images = self.bg_source.next_frames(n)
+        fg_images = self.fg_source.next_frames(n)
+        bg_version = self.bg_source.frame_version()
+        fg_version = self.fg_source.frame_version()
+        if (self.frame is not None and self.frame.shape == bg_images.shape[1:] and bg_version is not None and fg_version is not None
+                and bg_version == self.bg_version and fg_version == self.fg_version):
+            return Source._write_frames(self.frame, n, out)
 
-            bg_image[bg_start[0]:bg_end[0], bg_start[1]:bg_end[1]][mask==255] = fg_image[fg_start[0]:fg_end[0], fg_start[1]:fg_end[1]][mask==255]
-        else:
-            bg_image[bg_start[0]:bg_end[0], bg_start[1]:bg_end[1]] = fg_image[fg_start[0]:fg_end[0], fg_start[1]:fg_end[1]]
-        return bg_image
+        if out is None:
+            if self.block is None or self.block.shape != bg_images.shape:
+                self.block = np.empty(bg_images.shape, bg_images.dtype)
+            out = self.block
+        Source._compose_frames(out, bg_images, [(self.blender, fg_images, self.margin_top, self.margin_left)])
 
-    def next_frame(self):
-        bg_image = self.bg_source.next_frame().copy()
-        fg_image = self.fg_source.next_frame()
-        return self.combine(bg_image, fg_image)
+        # The retained canvas continues from the last frame
+        if self.frame is None or self.frame.shape != bg_images.shape[1:]:
+            self.frame = np.empty_like(bg_images[0])
+        np.copyto(self.frame, out[-1])
+        self.bg_version = bg_version
+        self.fg_version = fg_version
+        self._changed()
+        return out
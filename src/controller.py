@@ -3,6 +3,7 @@
 #  This source code is licensed under the license found in the
 #  LICENSE file in the root directory of this source tree.
 
+import numpy as np
 from source import Source
 from functools import reduce
 from combinator import MarginCombinator
@@ -36,15 +37,20 @@ class Controller(Source):
         self.current_count = 0
 
         self.last_frame = None
+        self.frame_key = None
+        self.block = None
 
         self.frame_count = 0
         self.frame_total = 0
+        self.seeked = False
 
     def add_phase(self, source, duration):
+        # Durations are whole frames, e.g. a 2.5 second phase at 15 fps lasts 38 frames
+        duration = 0 if duration == None or duration < 0 else int(round(duration))
         self.phases.append(
             Controller.Phase(
                 source,
-                0 if duration == None or duration < 0 else duration
+                duration
             )
         )
         self.frame_total += duration
@@ -52,6 +58,47 @@ class Controller(Source):
     def duration(self):
         return self.frame_total
 
+    def children(self):
+        return [phase.source for phase in self.phases]
+
+    def phase_ranges(self):
+        """
+        Returns the frames played by each phase.
+        Each phase is shown for its duration plus one frame, and the sequence is cut at the total duration.
+
+        Returns:
+            list: A (start, end) range of frame indexes for every phase that is played.
+        """
+        ranges = []
+        start = 0
+        for phase in self.phases:
+            end = min(start + phase.duration + 1, self.frame_total)
+            if start >= end:
+                break
+            ranges.append((start, end))
+            start = end
+        return ranges
+
+    def segments(self, frame_count, chunk_frames=None):
+        """
+        Splits the first frame_count frames into independent segments, one per phase, or chunks of at most chunk_frames frames.
+
+        Parameters:
+            frame_count (int): The amount of frames to split.
+            chunk_frames (int): The maximum length of a segment. Default is None, which keeps phases whole.
+
+        Returns:
+            list: A (start, count) pair for every segment, in order.
+        """
+        segments = []
+        for start, end in self.phase_ranges():
+            end = min(end, frame_count)
+            while start < end:
+                count = end - start if chunk_frames == None else min(chunk_frames, end - start)
+                segments.append((start, count))
+                start += count
+        return segments
+
     def reset(self, products):
         for phase in self.phases:
             phase.source.reset(products)
@@ -60,19 +107,46 @@ class Controller(Source):
         self.current = None
         self.current_count = 0
         self.last_frame = None
+        self.frame_key = None
         self.frame_count = 0
+        self.seeked = False
 
-    def next_frame(self):
-        if self.frame_count == self.frame_total:
-            return self.last_frame
+    def seek(self, index):
+        """
+        Moves to the given frame of the sequence. The source of its phase is seeked to the matching frame,
+        and the sources of the following phases are rewound as they are entered.
+        Past the end of the sequence, the last frame is rendered once and then repeated.
+        """
+        ranges = self.phase_ranges()
+        if len(ranges) == 0:
+            return
+        index = max(0, min(index, ranges[-1][1] - 1))
+        phase = next(i for i, (start, end) in enumerate(ranges) if index < end)
+        start = ranges[phase][0]
+
+        self.current = self.phases[phase]
+        self.current.source.seek(index - start)
+        self.iterator = iter(self.phases[phase + 1:])
+        # The frame count is incremented before the frame is rendered
+        self.current_count = index - start - 1
+        self.frame_count = index
+        self.last_frame = None
+        self.frame_key = None
+        self.seeked = True
+
+    def next_frame(self, out=None):
+        if self.frame_count >= self.frame_total:
+            return Source._write(self.last_frame, out)
 
         if self.iterator == None:
             self.iterator = iter(self.phases)
 
-        if self.current == None or self.current_count == self.current.duration:
+        if self.current == None or self.current_count >= self.current.duration:
             self.current = next(self.iterator)
             #while self.current.source == None:
             #    self.current = next(self.iterator)
+            if self.seeked:
+                self.current.source.seek(0)
             self.current_count = 0
             self.current_end = self.current.duration
         else:
@@ -81,4 +155,44 @@ class Controller(Source):
         self.frame_count = self.frame_count + 1
 
         self.last_frame = self.current.source.next_frame()
-        return self.last_frame
+        self._update_version()
+        return Source._write(self.last_frame, out)
+
+    def next_frames(self, n, out=None):
+        """
+        Returns the next n frames as a block. The frames of each phase within the block are pulled from its source at once,
+        and the frames where phases change, or past the end of the sequence, one by one.
+        """
+        frame = self.next_frame()
+        if out is None:
+            if self.block is None or self.block.shape != (n,) + frame.shape:
+                self.block = np.empty((n,) + frame.shape, frame.dtype)
+            out = self.block
+        out[0] = frame
+
+        i = 1
+        while i < n:
+            count = min(n - i, self.current.duration - self.current_count, self.frame_total - self.frame_count)
+            if count <= 0:
+                out[i] = self.next_frame()
+                i += 1
+                continue
+
+            self.current.source.next_frames(count, out=out[i:i + count])
+            self.current_count += count
+            self.frame_count += count
+            self._update_version()
+            i += count
+            # Frames past the end repeat the last one, which must outlive the block
+            if self.frame_count >= self.frame_total:
+                self.last_frame = out[i - 1].copy()
+        return out
+
+    def _update_version(self):
+        # Changes within the same phase are forwarded along with their area
+        frame_key = (self.current, self.current.source.frame_version())
+        if frame_key[1] is None or frame_key != self.frame_key:
+            incremental = (self.frame_key is not None and frame_key[0] == self.frame_key[0]
+                    and frame_key[1] is not None and self.frame_key[1] is not None and frame_key[1] == self.frame_key[1] + 1)
+            self._changed(self.current.source.changed_rect() if incremental else None)
+            self.frame_key = frame_key
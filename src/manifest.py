@@ -0,0 +1,106 @@
+#  Copyright (c) Meta Platforms, Inc. and affiliates.
+#  All rights reserved.
+#  This source code is licensed under the license found in the
+#  LICENSE file in the root directory of this source tree.
+
+import hashlib
+import json
+import os
+import time
+from os.path import abspath, basename, dirname, exists
+
+class Manifest:
+    """
+    A record of the inputs every output video was rendered from, stored as JSON next to the outputs.
+    Each output is keyed by a hash of everything that determines its pixels, so that a batch only renders again
+    the outputs whose inputs changed or that are missing.
+    File contents are hashed once and reused while their size and modification time stay the same.
+    """
+
+    VERSION = 1
+
+    def __init__(self, path, save_interval=5):
+        """
+        The constructor for Manifest class. Loads the manifest if it exists.
+
+        Parameters:
+            path (str): The path of the manifest file.
+            save_interval (float): The minimum amount of seconds between saves when outputs are recorded. Default is 5.
+        """
+        self.path = path
+        self.save_interval = save_interval
+        self.outputs = dict()
+        self.files = dict()
+        self.used_files = dict()
+        self.last_save = time.monotonic()
+
+        if exists(path):
+            try:
+                with open(path) as manifest_file:
+                    data = json.load(manifest_file)
+                if data.get("version") == Manifest.VERSION:
+                    self.outputs = data.get("outputs", dict())
+                    self.files = data.get("files", dict())
+            except (OSError, ValueError):
+                print(f"\tIgnoring unreadable manifest \"{path}\"")
+
+    def file_hash(self, path):
+        """
+        Returns the SHA-1 of the contents of a file, hashing it only if it changed since it was last hashed.
+        """
+        path = abspath(path)
+        stat = os.stat(path)
+        entry = self.files.get(path)
+        if entry == None or entry[0] != stat.st_size or entry[1] != stat.st_mtime_ns:
+            digest = hashlib.sha1()
+            with open(path, 'rb') as input_file:
+                for chunk in iter(lambda: input_file.read(1 << 20), b''):
+                    digest.update(chunk)
+            entry = [stat.st_size, stat.st_mtime_ns, digest.hexdigest()]
+        self.used_files[path] = entry
+        return entry[2]
+
+    def key(self, files, settings=None):
+        """
+        Returns a hash of the contents of the given files, independent of their order, and of the given settings.
+
+        Parameters:
+            files (list): The paths of the input files.
+            settings (dict): Other inputs, serializable to JSON. Default is None.
+        """
+        digest = hashlib.sha1(json.dumps(settings, sort_keys=True, default=str).encode())
+        for path in sorted(abspath(path) for path in files):
+            digest.update(path.encode())
+            digest.update(self.file_hash(path).encode())
+        return digest.hexdigest()
+
+    def is_current(self, output, key):
+        """
+        Returns True if the output exists and was rendered from inputs with the given key.
+        """
+        return exists(output) and self.outputs.get(basename(output)) == key
+
+    def forget(self, output):
+        """
+        Removes an output about to be rendered again, so that it is not taken as current if rendering is interrupted.
+        """
+        self.outputs.pop(basename(output), None)
+
+    def record(self, output, key):
+        """
+        Records that an output was rendered from inputs with the given key, saving the manifest at most every save_interval seconds.
+        """
+        self.outputs[basename(output)] = key
+        if time.monotonic() - self.last_save >= self.save_interval:
+            self.save()
+
+    def save(self):
+        """
+        Writes the manifest atomically. Only the hashes of files used in this run are kept.
+        """
+        os.makedirs(dirname(abspath(self.path)), exist_ok=True)
+        temporary = self.path + ".tmp"
+        with open(temporary, 'w') as manifest_file:
+            json.dump({"version": Manifest.VERSION, "outputs": self.outputs, "files": self.used_files}, manifest_file, indent=1)
+        os.replace(temporary, self.path)
+        self.last_save = time.monotonic()
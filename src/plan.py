@@ -0,0 +1,176 @@
+#  Copyright (c) Meta Platforms, Inc. and affiliates.
+#  All rights reserved.
+#  This source code is licensed under the license found in the
+#  LICENSE file in the root directory of this source tree.
+
+import numpy as np
+from combinator import Blender, MarginCombinator
+from controller import Controller
+from source import Source, intersect_rect, offset_rect, parts_shape, union_rect
+
+class PlanSource(Source):
+    """
+    This class composites a flat list of layers over a base source into a single canvas retained between frames.
+    It produces the same frames as the chain of MarginCombinators it is compiled from, with one canvas and one loop for all layers.
+    """
+    class Layer:
+        def __init__(self, source, top, left, blender):
+            """
+            The descriptor for each layer of the plan
+
+            Parameters:
+                source (Source): The media source of this layer
+                top (int): The row of the canvas where the frames of the source start
+                left (int): The column of the canvas where the frames of the source start
+                blender (Blender): Blends the frames of the source into the canvas
+            """
+            self.source = source
+            self.top = top
+            self.left = left
+            self.blender = blender
+            self.clip = None
+            self.version = None
+
+    def __init__(self, base_source, layers):
+        """
+        The constructor for PlanSource class.
+
+        Parameters:
+            base_source (Source): The Source providing the background, and the size of the canvas.
+            layers (list of Layer): The layers blended over the background, from bottom to top.
+        """
+        self.base_source = base_source
+        self.layers = layers
+        top = layers[-1].source if len(layers) > 0 else base_source
+        # Blended as a whole with the strategy of its topmost layer, as the outermost MarginCombinator would
+        self.blending = top.blending_strategy()
+        self.chroma_color = top.chroma_color
+        self.frame = None
+        self.block = None
+        self.base_version = None
+
+    def is_static(self):
+        return self.base_source.is_static() and all(layer.source.is_static() for layer in self.layers)
+
+    def children(self):
+        return [self.base_source] + [layer.source for layer in self.layers]
+
+    def reset(self, products):
+        self.base_source.reset(products)
+        for layer in self.layers:
+            layer.source.reset(products)
+            layer.blender.reset()
+        self.frame = None
+
+    def seek(self, index):
+        self.base_source.seek(index)
+        for layer in self.layers:
+            layer.source.seek(index)
+            layer.blender.reset()
+        # Static plans do not depend on the frame index
+        if not self.is_static():
+            self.frame = None
+
+    def next_frame(self, out=None):
+        """
+        Pulls the next frame of every layer and blends them over the background.
+        Static plans are composed only once, and otherwise only the areas where any layer changed are composed again.
+        """
+        if self.frame is not None and self.is_static():
+            return Source._write(self.frame, out)
+
+        bg_image = self.base_source.next_frame()
+        # Layers are pulled as parts, so that sources made of several images are never assembled
+        parts = [layer.blender.next_parts() for layer in self.layers]
+        shapes = [parts_shape(layer_parts) for layer_parts in parts]
+        bg_version = self.base_source.frame_version()
+
+        full = (0, 0, bg_image.shape[0], bg_image.shape[1])
+        if self.frame is None or self.frame.shape != bg_image.shape:
+            self.frame = np.empty_like(bg_image)
+            dirty = full
+        else:
+            dirty = Source._changed_area(self.base_source, bg_version, self.base_version, bg_image.shape)
+            for layer, shape in zip(self.layers, shapes):
+                dirty = union_rect(dirty, offset_rect(
+                        Source._changed_area(layer.source, layer.source.frame_version(), layer.version, shape),
+                        layer.top, layer.left))
+            dirty = intersect_rect(dirty, full)
+
+        self.base_version = bg_version
+        for layer, shape in zip(self.layers, shapes):
+            layer.version = layer.source.frame_version()
+            layer.clip = intersect_rect(full, (layer.top, layer.left, layer.top + shape[0], layer.left + shape[1]))
+        if dirty is None:
+            return Source._write(self.frame, out)
+
+        self.frame[dirty[0]:dirty[2], dirty[1]:dirty[3]] = bg_image[dirty[0]:dirty[2], dirty[1]:dirty[3]]
+        for layer, layer_parts in zip(self.layers, parts):
+            rect = intersect_rect(dirty, layer.clip)
+            if rect is not None:
+                layer.blender.blend_parts(self.frame, layer_parts, layer.top, layer.left, rect)
+        self._changed(None if dirty == full else dirty)
+        return Source._write(self.frame, out)
+
+    def next_frames(self, n, out=None):
+        """
+        Pulls the next n frames of every layer as blocks and blends each layer over the whole block at once.
+        If no layer changed since the last frame, the retained canvas is repeated without composing it again.
+        """
+        if self.frame is not None and self.is_static():
+            return Source._write_frames(self.frame, n, out)
+
+        bg_images = self.base_source.next_frames(n)
+        images = [layer.source.next_frames(n) for layer in self.layers]
+        bg_version = self.base_source.frame_version()
+        versions = [layer.source.frame_version() for layer in self.layers]
+        if (self.frame is not None and self.frame.shape == bg_images.shape[1:] and bg_version is not None and bg_version == self.base_version
+                and all(version is not None and version == layer.version for layer, version in zip(self.layers, versions))):
+            return Source._write_frames(self.frame, n, out)
+
+        if out is None:
+            if self.block is None or self.block.shape != bg_images.shape:
+                self.block = np.empty(bg_images.shape, bg_images.dtype)
+            out = self.block
+        full = (0, 0, bg_images.shape[1], bg_images.shape[2])
+        Source._compose_frames(out, bg_images, [(layer.blender, layer_images, layer.top, layer.left) for layer, layer_images in zip(self.layers, images)])
+
+        # The retained canvas continues from the last frame
+        if self.frame is None or self.frame.shape != bg_images.shape[1:]:
+            self.frame = np.empty_like(bg_images[0])
+        np.copyto(self.frame, out[-1])
+        self.base_version = bg_version
+        for layer, layer_images, version in zip(self.layers, images, versions):
+            layer.version = version
+            layer.clip = intersect_rect(full, (layer.top, layer.left, layer.top + layer_images.shape[1], layer.left + layer_images.shape[2]))
+        self._changed()
+        return out
+
+def compile_plan(source):
+    """
+    Flattens the chains of MarginCombinators of a source tree into PlanSources.
+    Each chain of combinators stacked on their background becomes one plan whose layers are the products of the chain,
+    positioned by their margins. Products that are combinations themselves are compiled into nested plans,
+    since they are blended over the background as a whole. The phases of a Controller are compiled in place.
+
+    Parameters:
+        source (Source): The root of the source tree.
+
+    Returns:
+        Source: A source producing the same frames.
+    """
+    if isinstance(source, Controller):
+        for phase in source.phases:
+            phase.source = compile_plan(phase.source)
+        return source
+
+    if not isinstance(source, MarginCombinator):
+        return source
+
+    layers = []
+    while isinstance(source, MarginCombinator):
+        fg_source = compile_plan(source.fg_source)
+        layers.append(PlanSource.Layer(fg_source, source.margin_top, source.margin_left, Blender(fg_source, source.alpha_engine)))
+        source = source.bg_source
+    layers.reverse()
+    return PlanSource(compile_plan(source), layers)
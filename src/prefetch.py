@@ -0,0 +1,100 @@
+#  Copyright (c) Meta Platforms, Inc. and affiliates.
+#  All rights reserved.
+#  This source code is licensed under the license found in the
+#  LICENSE file in the root directory of this source tree.
+
+from cache import asset_cache
+from concurrent.futures import ThreadPoolExecutor, wait
+from source import Source, ImageSlideshowSource
+
+class Prefetcher:
+    """
+    Loads the product images of the upcoming videos in a pool of threads while the current video renders.
+    Images are decoded and rescaled into the process-wide asset cache at every resolution the slideshows of the
+    source tree use, so resetting the sources for the next product finds them ready instead of reading them synchronously.
+    """
+
+    def __init__(self, source, products, depth=1, max_bytes=256 * 1024 * 1024, workers=4):
+        """
+        The constructor for Prefetcher class.
+
+        Parameters:
+            source (Source): The root of the source tree the products are rendered with.
+            products (list): The image paths of every product, in the order they are rendered.
+            depth (int): The amount of products loaded ahead of the one rendering. Default is 1.
+            max_bytes (int): The memory budget of the images loaded ahead. Capped to half the asset cache budget, so that they are not evicted before use. Default is 256MB.
+            workers (int): The amount of loading threads. Default is 4.
+        """
+        self.products = products
+        self.depth = max(0, depth)
+        self.max_bytes = min(max_bytes, asset_cache.max_bytes // 2)
+        self.resolutions = sorted(Prefetcher._slideshow_resolutions(source))
+        self.executor = ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix="prefetch") if self.depth > 0 and len(self.resolutions) > 0 else None
+        self.futures = dict()
+        self.sizes = dict()
+        self.size = 0
+        self.next = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def advance(self, index):
+        """
+        Waits for the images of the product about to render, and starts loading the following ones within the lookahead depth and memory budget.
+
+        Parameters:
+            index (int): The index of the product about to render.
+        """
+        if self.executor is None:
+            return
+
+        # Loading the current product is started right away if it was not ahead yet
+        self._schedule(index, index)
+        wait(self.futures.pop(index, []))
+        self.size -= self.sizes.pop(index, 0)
+
+        self.next = max(self.next, index + 1)
+        while self.next <= min(index + self.depth, len(self.products) - 1):
+            size = self._size(self.next)
+            # At least one product is always loaded ahead, even if it exceeds the budget on its own
+            if self.size > 0 and self.size + size > self.max_bytes:
+                break
+            self._schedule(self.next, index)
+            self.next += 1
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=True, cancel_futures=True)
+            self.executor = None
+
+    def _schedule(self, product, current):
+        if product in self.futures:
+            return
+        self.futures[product] = [self.executor.submit(Prefetcher._load, path, resolution)
+                for path in self.products[product] for resolution in self.resolutions]
+        if product > current:
+            self.sizes[product] = self._size(product)
+            self.size += self.sizes[product]
+
+    def _size(self, product):
+        return sum(width * height * 4 for width, height in self.resolutions) * len(self.products[product])
+
+    def _load(path, resolution):
+        # Failures are left for the source to raise when it loads the image itself
+        try:
+            Source._load_image(path, resolution)
+        except Exception:
+            pass
+
+    def _slideshow_resolutions(source):
+        resolutions = set()
+        pending = [source]
+        while len(pending) > 0:
+            node = pending.pop()
+            if isinstance(node, ImageSlideshowSource):
+                resolutions.add(tuple(node.dimensions))
+            pending.extend(node.children())
+        return resolutions
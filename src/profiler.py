@@ -0,0 +1,261 @@
+#  Copyright (c) Meta Platforms, Inc. and affiliates.
+#  All rights reserved.
+#  This source code is licensed under the license found in the
+#  LICENSE file in the root directory of this source tree.
+
+import functools
+import json
+import os
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+from os.path import basename
+
+class Profiler:
+    """
+    An opt-in instrumentation layer for a Source tree.
+    Every node of the tree has its frame and reset methods wrapped with timers, and optionally with allocation tracking,
+    so that a slow template can be traced back to the node responsible. Results are available as a summary printed
+    as a tree and as a Chrome trace, which can be opened in chrome://tracing or ui.perfetto.dev.
+    """
+
+    # Methods wrapped on every node. Frames are pulled through next_frame, in blocks through next_frames or, by blenders, through next_parts
+    FRAME_METHODS = ('next_frame', 'next_frames', 'next_parts')
+    OTHER_METHODS = ('reset', 'seek')
+
+    class Node:
+        def __init__(self, name, source):
+            """
+            The statistics of one instrumented object
+
+            Parameters:
+                name (str): The name shown in the summary and the trace
+                source (Source): The instrumented source, or None for the encoder
+            """
+            self.name = name
+            self.source = source
+            self.calls = dict()
+            self.total = dict()
+            self.own = dict()
+            self.peak_bytes = 0
+
+        def add(self, method, elapsed, own):
+            self.calls[method] = self.calls.get(method, 0) + 1
+            self.total[method] = self.total.get(method, 0.0) + elapsed
+            self.own[method] = self.own.get(method, 0.0) + own
+
+        def frame_stats(self):
+            # Frame methods are reported together, nested calls within the same node are only counted once
+            calls = sum(self.calls.get(method, 0) for method in Profiler.FRAME_METHODS)
+            total = sum(self.total.get(method, 0.0) for method in Profiler.FRAME_METHODS)
+            own = sum(self.own.get(method, 0.0) for method in Profiler.FRAME_METHODS)
+            return calls, total, own
+
+    def __init__(self, track_memory=False, max_events=1000000):
+        """
+        The constructor for Profiler class.
+
+        Parameters:
+            track_memory (bool): If True, the peak bytes allocated during each call are tracked with tracemalloc. This slows down rendering. Default is False.
+            max_events (int): The maximum amount of events kept for the trace. Later calls are still counted in the summary. Default is 1000000.
+        """
+        self.track_memory = track_memory
+        self.max_events = max_events
+        self.nodes = dict()
+        self.roots = []
+        self.events = []
+        self.dropped_events = 0
+        self.threads = dict()
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.origin = time.perf_counter()
+        self.pid = os.getpid()
+        if track_memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    def instrument(self, source):
+        """
+        Wraps the methods of every node of a Source tree. Nodes shared by several parents are instrumented once.
+
+        Parameters:
+            source (Source): The root of the tree.
+
+        Returns:
+            Source: The same source, now instrumented.
+        """
+        self.roots.append(source)
+        pending = [source]
+        while len(pending) > 0:
+            node = pending.pop()
+            if id(node) in self.nodes:
+                continue
+            self.nodes[id(node)] = Profiler.Node(Profiler._describe(node), node)
+            for method in Profiler.FRAME_METHODS + Profiler.OTHER_METHODS:
+                if hasattr(node, method):
+                    self._wrap(node, method, self.nodes[id(node)])
+            pending.extend(node.children())
+        return source
+
+    def instrument_sink(self, sink):
+        """
+        Wraps the encoding of a Sink, so that the time spent converting and encoding frames is reported.
+        Every instrumented Sink is reported as the same node.
+        """
+        if 'sink' not in self.nodes:
+            self.nodes['sink'] = Profiler.Node("Sink encode", None)
+        self._wrap(sink, '_encode', self.nodes['sink'])
+        return sink
+
+    @contextmanager
+    def span(self, name, category="batch"):
+        """
+        Records a span of the trace around a block, e.g. the rendering of one product.
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self._event(name, category, start, time.perf_counter() - start)
+
+    def print_summary(self):
+        """
+        Prints the statistics of every node, indented following the tree, followed by the encoder.
+        Total time includes the children of a node, self time excludes them.
+        """
+        rows = [("Node", "Calls", "Total ms", "Self ms", "Self ms/call", "Reset ms", "Peak alloc")]
+        printed = set()
+        for root in self.roots:
+            self._rows(root, 0, rows, printed)
+        if 'sink' in self.nodes:
+            rows.append(self._row(self.nodes['sink'], 0, False, method='_encode'))
+
+        widths = [max(len(row[i]) for row in rows) for i in range(len(rows[0]))]
+        for row in rows:
+            print("\t" + row[0].ljust(widths[0]) + "".join("  " + row[i].rjust(widths[i]) for i in range(1, len(row))))
+        if self.dropped_events > 0:
+            print(f"\t{self.dropped_events} calls were left out of the trace past {self.max_events} events")
+
+    def write_trace(self, path):
+        """
+        Writes every recorded call as a Chrome trace event file.
+        """
+        metadata = [{"name": "thread_name", "ph": "M", "pid": self.pid, "tid": tid, "args": {"name": name}}
+                for tid, name in self.threads.items()]
+        with open(path, 'w') as trace_file:
+            json.dump({"traceEvents": metadata + self.events, "displayTimeUnit": "ms"}, trace_file)
+
+    def _wrap(self, target, method, node):
+        function = getattr(target, method)
+
+        # Keeps the signature of the method, which callers may inspect
+        @functools.wraps(function)
+        def timed(*args, **kwargs):
+            return self._call(node, method, function, args, kwargs)
+        setattr(target, method, timed)
+
+    def _call(self, node, method, function, args, kwargs):
+        stack = getattr(self.local, 'stack', None)
+        if stack is None:
+            stack = self.local.stack = []
+
+        # Calls of a node to its own methods, e.g. next_frame assembling next_parts, belong to the outer call
+        if len(stack) > 0 and stack[-1]["node"] is node:
+            return function(*args, **kwargs)
+
+        frame = {"node": node, "children": 0.0, "peak": 0}
+        if self.track_memory:
+            current, peak = tracemalloc.get_traced_memory()
+            if len(stack) > 0:
+                stack[-1]["peak"] = max(stack[-1]["peak"], peak)
+            frame["memory"] = current
+            tracemalloc.reset_peak()
+        stack.append(frame)
+
+        start = time.perf_counter()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            elapsed = time.perf_counter() - start
+            stack.pop()
+            if len(stack) > 0:
+                stack[-1]["children"] += elapsed
+            with self.lock:
+                node.add(method, elapsed, elapsed - frame["children"])
+                if self.track_memory:
+                    peak = max(tracemalloc.get_traced_memory()[1], frame["peak"])
+                    node.peak_bytes = max(node.peak_bytes, peak - frame["memory"])
+                    if len(stack) > 0:
+                        stack[-1]["peak"] = max(stack[-1]["peak"], peak)
+            self._event(node.name, method, start, elapsed)
+
+    def _event(self, name, category, start, elapsed):
+        thread = threading.current_thread()
+        with self.lock:
+            self.threads[thread.ident] = thread.name
+            if len(self.events) >= self.max_events:
+                self.dropped_events += 1
+                return
+            self.events.append({
+                "name": name,
+                "cat": category,
+                "ph": "X",
+                "ts": (start - self.origin) * 1e6,
+                "dur": elapsed * 1e6,
+                "pid": self.pid,
+                "tid": thread.ident
+            })
+
+    def _rows(self, source, depth, rows, printed):
+        node = self.nodes.get(id(source))
+        if node is None:
+            return
+        shared = id(source) in printed
+        rows.append(self._row(node, depth, shared))
+        if shared:
+            return
+        printed.add(id(source))
+        for child in source.children():
+            self._rows(child, depth + 1, rows, printed)
+
+    def _row(self, node, depth, shared, method=None):
+        if method is None:
+            calls, total, own = node.frame_stats()
+        else:
+            calls, total, own = node.calls.get(method, 0), node.total.get(method, 0.0), node.own.get(method, 0.0)
+        name = "  " * depth + node.name + (" (shared, see above)" if shared else "")
+        if shared:
+            return (name, "", "", "", "", "", "")
+        return (
+            name,
+            str(calls),
+            f"{total * 1000:.1f}",
+            f"{own * 1000:.1f}",
+            f"{own * 1000 / calls:.3f}" if calls > 0 else "-",
+            f"{sum(node.total.get(m, 0.0) for m in Profiler.OTHER_METHODS) * 1000:.1f}",
+            Profiler._format_bytes(node.peak_bytes) if self.track_memory else "-"
+        )
+
+    def _describe(source):
+        # A short name telling apart the nodes of a tree
+        name = type(source).__name__
+        if getattr(source, 'video_path', None) is not None:
+            return f"{name} {basename(source.video_path)}"
+        if hasattr(source, 'dimensions'):
+            return f"{name} {source.dimensions[0]}x{source.dimensions[1]}"
+        if hasattr(source, 'min_scale'):
+            return f"{name} min scale {float(source.min_scale):g}"
+        if hasattr(source, 'margin_top'):
+            return f"{name} at ({source.margin_left}, {source.margin_top})"
+        if hasattr(source, 'layers'):
+            return f"{name} {len(source.layers)} layers"
+        if hasattr(source, 'phases'):
+            return f"{name} {len(source.phases)} phases"
+        return name
+
+    def _format_bytes(size):
+        for unit in ("B", "KB", "MB"):
+            if size < 1024:
+                return f"{size:.0f}{unit}"
+            size /= 1024
+        return f"{size:.1f}GB"
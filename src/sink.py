@@ -3,20 +3,71 @@
 #  This source code is licensed under the license found in the
 #  LICENSE file in the root directory of this source tree.
 
-import cv2
-import os
+import av
+import numpy as np
+import queue
 import source
-from tempfile import gettempdir
-from moviepy.editor import VideoFileClip, AudioFileClip
+import threading
+import time as timer
+from fractions import Fraction
 
 class Sink():
     """
     A class to create a video from a source and add audio if provided.
+    Video frames are encoded and the audio track is muxed in a single pass, with no intermediate file.
+    Frames the source reports as unchanged through its frame version are held: the frame converted for the encoder
+    is submitted again, or with variable frame rate, not encoded at all until the source changes.
     """
 
-    TEMP_FILE = os.path.join(gettempdir(), "tmp.mp4")
+    # Modes for frames unchanged since the previous one
+    HOLD_MODES = ("none", "resubmit", "vfr")
 
-    def __init__(self, source: source.Source, target_fps=60, time=15, output_video_path="sample.mp4"):
+    class Audio():
+        """
+        An audio track copied into the output container, re-encoded as AAC and trimmed to the video duration.
+        """
+
+        def __init__(self, audio_path, container):
+            """
+            Opens the audio file and adds its stream to the output container.
+            Args:
+                audio_path (str): The path to the audio file.
+                container (av.container.OutputContainer): The container the audio is muxed into.
+            """
+            self.input = av.open(audio_path)
+            input_stream = self.input.streams.audio[0]
+
+            self.container = container
+            self.stream = container.add_stream('aac', rate=input_stream.rate)
+            # Inputs with an unnamed channel layout are not accepted by the encoder, so they are mapped to mono or stereo
+            self.stream.layout = 'mono' if input_stream.channels == 1 else 'stereo'
+            self.resampler = av.AudioResampler(format=self.stream.format.name, layout=self.stream.layout.name, rate=self.stream.rate)
+            self.frames = self.input.decode(audio=0)
+            self.samples = 0
+
+        def mux_until(self, time):
+            """
+            Encodes and muxes audio until the given time in seconds is covered, so that both streams stay interleaved.
+            Args:
+                time (float): The timestamp in seconds up to which audio is written.
+            """
+            while self.frames is not None and self.samples < time * self.stream.rate:
+                frame = next(self.frames, None)
+                if frame is None:
+                    self.frames = None
+                    break
+                for resampled in self.resampler.resample(frame):
+                    resampled.pts = self.samples
+                    resampled.time_base = Fraction(1, self.stream.rate)
+                    self.samples += resampled.samples
+                    self.container.mux(self.stream.encode(resampled))
+
+        def close(self):
+            self.container.mux(self.stream.encode(None))
+            self.input.close()
+
+    def __init__(self, source: source.Source, target_fps=60, time=15, output_video_path="sample.mp4", codec="mpeg4", queue_depth=0, frames=None,
+                 preset=None, crf=None, bit_rate=None, gop=None, pix_fmt="yuv420p", threads=None, hold="resubmit", batch_size=1):
         """
         Initializes the Sink class with the source, target fps, time, and output video path.
         Args:
@@ -24,55 +75,315 @@ class Sink():
             target_fps (int, optional): The target frames per second for the video. Default is 60.
             time (int, optional): The duration of the video in seconds. Default is 15.
             output_video_path (str, optional): The output path for the video. Default is "./sample.mp4".
+            codec (str, optional): The FFmpeg video encoder. Default is "mpeg4", the codec of the "mp4v" fourcc.
+            queue_depth (int, optional): If positive, frames are rendered in this thread into a queue of this many preallocated buffers,
+                and encoded by a separate thread. If 0, rendering and encoding alternate in this thread. Default is 0.
+            frames (int, optional): The amount of frames to encode. Overrides time when set. Default is None.
+            preset (str, optional): The encoder preset trading speed against size, e.g. "veryfast" or "slow" for libx264. Default is None, the encoder default.
+            crf (float, optional): The constant rate factor of encoders supporting it, such as libx264. Lower is better quality. Default is None.
+            bit_rate (int, optional): The target bitrate in bits per second. If neither bit_rate nor crf are set, the bitrate OpenCV used for mp4v is used. Default is None.
+            gop (int, optional): The maximum amount of frames between keyframes. Default is None, the encoder default.
+            pix_fmt (str, optional): The pixel format of the encoded video. Default is "yuv420p".
+            threads (int, optional): The amount of encoder threads, 0 to let the encoder choose. Default is None, the encoder default.
+            hold (str, optional): How frames unchanged since the previous one are written. "resubmit" encodes the previously converted frame again,
+                skipping the conversion, and produces the same video as encoding every frame. "vfr" skips them and lets the previous frame last longer,
+                in a variable frame rate video. "none" converts and encodes every frame. Default is "resubmit".
+            batch_size (int, optional): If greater than 1, frames are pulled from the source in blocks of this many frames with next_frames.
+                Frames are only held when a whole block is the same as the frame before it. Default is 1.
         """
+        if hold not in Sink.HOLD_MODES:
+            raise ValueError(f"Unknown hold mode \"{hold}\". Options are: {Sink.HOLD_MODES}")
         self.source = source
         self.target_fps = target_fps
         self.time = time
         self.output_video_path = output_video_path
+        self.codec = codec
+        self.queue_depth = queue_depth
+        self.frames = frames
+        self.preset = preset
+        self.crf = crf
+        self.bit_rate = bit_rate
+        self.gop = gop
+        self.pix_fmt = pix_fmt
+        self.threads = threads
+        self.hold = hold
+        self.batch_size = max(1, batch_size)
+        self.stats = None
+        self.held_frames = 0
 
-    def _add_audio(self, audio_path):
+    def create_video(self, audio_path=None):
         """
-        Adds audio to the video using the provided audio path.
+        Creates a video from the source and adds audio if provided.
         Args:
-            audio_path (str): The path to the audio file.
+            audio_path (str, optional): The path to the audio file. If not provided, no audio will be added.
         """
 
-        # Define two clips, one video and one audio
-        video_clip = VideoFileClip(Sink.TEMP_FILE)
-        audio_clip = AudioFileClip(audio_path)
+        source = self.source
+        target_fps = self.target_fps
+        frame_count = self.time * target_fps if self.frames is None else self.frames
 
-        # Combine the two clips
-        final_clip = video_clip.set_audio(audio_clip)
+        img = source.next_frame()
+        height, width = img.shape[:2]
+        self.held = None
+        self.held_frames = 0
+        self.last_pts = None
 
-        # Save
-        final_clip.write_videofile(self.output_video_path)
+        container = av.open(self.output_video_path, mode='w')
+        try:
+            stream = self._add_stream(container, width, height)
 
-    def create_video(self, audio_path=None):
+            audio = Sink.Audio(audio_path, container) if audio_path else None
+
+            if self.queue_depth > 0:
+                self._encode_pipelined(img, frame_count, lambda fr, frame: self._encode(container, stream, audio, fr, frame))
+            else:
+                for fr, frame in self._frames(img, frame_count):
+                    self._encode(container, stream, audio, fr, frame)
+
+            # The last frame of a variable frame rate video is written again, so that the video keeps its duration
+            if self.held is not None and self.last_pts is not None and self.last_pts < frame_count - 1:
+                self.held.pts = frame_count - 1
+                container.mux(stream.encode(self.held))
+
+            container.mux(stream.encode(None))
+            if audio:
+                audio.close()
+        finally:
+            container.close()
+
+    def _add_stream(self, container, width, height):
         """
-        Creates a video from the source and adds audio if provided.
+        Adds the video stream to the output container, configured with the encoder settings.
+        """
+        stream = container.add_stream(self.codec, rate=self.target_fps)
+        stream.width = width
+        stream.height = height
+        stream.pix_fmt = self.pix_fmt
+        if self.bit_rate is not None:
+            stream.bit_rate = int(self.bit_rate)
+        elif self.crf is None:
+            # Same bitrate OpenCV used for mp4v
+            stream.bit_rate = int(min(self.target_fps * width * height, 2**30))
+        if self.gop is not None:
+            stream.codec_context.gop_size = self.gop
+        if self.threads is not None:
+            stream.codec_context.thread_count = self.threads
+            stream.codec_context.thread_type = 'AUTO'
+
+        # Private options of the encoder, ignored by encoders that do not have them
+        options = dict()
+        if self.preset is not None:
+            options['preset'] = self.preset
+        if self.crf is not None:
+            options['crf'] = f"{self.crf:g}"
+        if len(options) > 0:
+            stream.options = options
+        return stream
+
+    def concatenate(segment_paths, output_video_path, audio_path=None):
+        """
+        Joins video files encoded with the same settings into one, copying their packets without re-encoding.
         Args:
-            audio_path (str, optional): The path to the audio file. If not provided, no audio will be added.
+            segment_paths (list): The paths of the segments, in order.
+            output_video_path (str): The output path for the video.
+            audio_path (str, optional): The path to an audio file muxed along the joined video. Default is None.
         """
+        container = av.open(output_video_path, mode='w')
+        try:
+            stream = None
+            audio = None
+            offset = 0
+            last_dts = None
+            time_base = None
 
-        output_video_path = Sink.TEMP_FILE if audio_path else self.output_video_path
+            for path in segment_paths:
+                segment = av.open(path)
+                try:
+                    input_stream = segment.streams.video[0]
+                    if stream is None:
+                        # PyAV 14 renamed stream templating
+                        if hasattr(container, 'add_stream_from_template'):
+                            stream = container.add_stream_from_template(input_stream)
+                        else:
+                            stream = container.add_stream(template=input_stream)
+                        audio = Sink.Audio(audio_path, container) if audio_path else None
 
-        source = self.source
-        target_fps = self.target_fps
-        time = self.time
+                    packets = [packet for packet in segment.demux(input_stream) if packet.dts is not None]
+                    if len(packets) == 0:
+                        continue
 
-        img = source.next_frame()
-        height, width = img.shape[:2]
-        
-        vw = cv2.VideoWriter(output_video_path, cv2.VideoWriter_fourcc(*'mp4v'), target_fps, (width, height))
+                    # Timestamps are read before muxing, which rescales packets to the output time base
+                    time_base = input_stream.time_base
+                    frame_duration = max(1, round(1 / (input_stream.average_rate * time_base)))
+                    end = offset
+                    for packet in packets:
+                        # Each segment is shown right after the previous one ends. Segments with reordered frames start
+                        # decoding before their first frame is shown, so their leading decoding timestamps are moved
+                        # just past the previous segment's, which keeps them increasing without delaying any frame
+                        packet.pts += offset
+                        packet.dts += offset
+                        if last_dts is not None and packet.dts <= last_dts:
+                            packet.dts = last_dts + 1
+                        packet.stream = stream
+                        last_dts = packet.dts
+                        end = max(end, packet.pts + (packet.duration or frame_duration))
+                        time = float(packet.dts * time_base)
+                        container.mux(packet)
+                        if audio:
+                            audio.mux_until(time)
+                    offset = end
+                finally:
+                    segment.close()
+
+            if audio:
+                if time_base is not None:
+                    audio.mux_until(float(offset * time_base))
+                audio.close()
+        finally:
+            container.close()
+
+    def _frames(self, img, frame_count):
+        """
+        Yields the index and pixels of every frame, pulling them from the source one by one or in blocks of batch_size frames.
+        Frames that are held are yielded as None. Pixels are only valid until the next frame is requested.
+        Args:
+            img (np.ndarray): The first frame, already rendered.
+            frame_count (int): The amount of frames.
+        """
+        version = self.source.frame_version()
+        if frame_count > 0:
+            yield 0, img
+
+        fr = 1
+        while fr < frame_count:
+            count = min(self.batch_size, frame_count - fr)
+            frames = self.source.next_frames(count) if count > 1 else [self.source.next_frame()]
+            last_version, version = version, self.source.frame_version()
+            held = self._is_held(version, last_version)
+            for i in range(count):
+                yield fr + i, None if held else frames[i]
+            fr += count
+
+    def _is_held(self, version, last_version):
+        """
+        Returns True if the frame with the given version is the same as the previous one and can be held.
+        """
+        return self.hold != "none" and version is not None and version == last_version
+
+    def _encode(self, container, stream, audio, fr, img):
+        """
+        Encodes a single BGRA frame at the given index, along with the audio up to its end.
+        If img is None, the frame is the same as the previous one and is held.
+        """
+        if img is not None:
+            # BGRA frames are converted to the encoder pixel format by PyAV
+            frame = av.VideoFrame.from_ndarray(np.ascontiguousarray(img), format='bgra')
+            if self.hold != "none":
+                # Converted here rather than by the encoder, so that the converted frame can be submitted again
+                frame = frame.reformat(format=stream.pix_fmt)
+                self.held = frame
+        else:
+            self.held_frames += 1
+            frame = self.held if self.hold == "resubmit" else None
+
+        if frame is not None:
+            frame.pts = fr
+            self.last_pts = fr
+            container.mux(stream.encode(frame))
+        if audio:
+            audio.mux_until((fr + 1) / self.target_fps)
+
+    def _encode_pipelined(self, img, frame_count, encode):
+        """
+        Renders frames in this thread and encodes them in a separate one, through a bounded queue of preallocated buffers.
+        Each buffer holds a block of batch_size frames, which next_frame_into and next_frames render into directly.
+        OpenCV and the encoder release the GIL, so rendering and encoding overlap.
+        Stall statistics are stored in self.stats:
+            render_stalls: buffers for which rendering waited on a free one, i.e. encoding is the bottleneck.
+            encode_stalls: buffers for which encoding waited on rendering, i.e. rendering is the bottleneck.
+        Held frames and blocks give their buffer back right away and are queued without one.
+        Static sources are pulled without a buffer, since their frames are only used when they are not held.
+        Args:
+            img (np.ndarray): The first frame, already rendered.
+            frame_count (int): The amount of frames to encode.
+            encode (callable): Encodes a frame given its index and pixels, None for held frames.
+        """
+        free = queue.Queue()
+        for _ in range(self.queue_depth):
+            free.put(np.empty((self.batch_size,) + img.shape, img.dtype))
+        rendered = queue.Queue()
+
+        stats = {
+            "queue_depth": self.queue_depth,
+            "render_stalls": 0,
+            "render_stall_time": 0.0,
+            "encode_stalls": 0,
+            "encode_stall_time": 0.0
+        }
+        errors = []
+
+        def consume():
+            while True:
+                start = timer.perf_counter()
+                if rendered.empty():
+                    stats["encode_stalls"] += 1
+                item = rendered.get()
+                stats["encode_stall_time"] += timer.perf_counter() - start
+                if item is None:
+                    return
+
+                fr, buffer, count = item
+                # After a failure, buffers are still returned so that rendering can finish
+                if len(errors) == 0:
+                    try:
+                        for i in range(count):
+                            encode(fr + i, None if buffer is None else buffer[i])
+                    except Exception as error:
+                        errors.append(error)
+                if buffer is not None:
+                    free.put(buffer)
+
+        consumer = threading.Thread(target=consume, name="sink-encoder")
+        consumer.start()
+        try:
+            fr = 0
+            version = self.source.frame_version()
+            while fr < frame_count and len(errors) == 0:
+                count = 1 if fr == 0 else min(self.batch_size, frame_count - fr)
 
-        if not vw.isOpened():
-            raise Exception("OpenCV cannot recognize the codec used by the temporary video.")
+                static = fr > 0 and self.source.is_static()
+                if static:
+                    img = self.source.next_frame() if count == 1 else self.source.next_frames(count)
+                    last_version, version = version, self.source.frame_version()
+                    if self._is_held(version, last_version):
+                        rendered.put((fr, None, count))
+                        fr += count
+                        continue
 
-        for fr in range(time * target_fps):
-            vw.write(cv2.cvtColor(img, cv2.COLOR_BGRA2BGR))
-            img = source.next_frame()
+                start = timer.perf_counter()
+                if free.empty():
+                    stats["render_stalls"] += 1
+                buffer = free.get()
+                stats["render_stall_time"] += timer.perf_counter() - start
 
-        vw.release()
+                if fr == 0 or static:
+                    buffer[:count] = img
+                elif count == 1:
+                    source.next_frame_into(self.source, buffer[0])
+                else:
+                    self.source.next_frames(count, out=buffer[:count])
+                if not static and fr > 0:
+                    last_version, version = version, self.source.frame_version()
+                    if self._is_held(version, last_version):
+                        free.put(buffer)
+                        buffer = None
+                rendered.put((fr, buffer, count))
+                fr += count
+        finally:
+            rendered.put(None)
+            consumer.join()
 
-        if audio_path:
-            self._add_audio(audio_path)
+        stats["held_frames"] = self.held_frames
+        self.stats = stats
+        if len(errors) > 0:
+            raise errors[0]
@@ -5,9 +5,13 @@
 
 import av
 import cv2
+import inspect
 import numpy as np
 import platform, os
+from cache import asset_cache, frame_store
+from collections import deque
 from enum import Enum
+from fractions import Fraction
 
 class Blending(Enum):
     """
@@ -16,23 +20,263 @@ class Blending(Enum):
     ALPHA=0
     CHROMA_KEYING=1
 
+def intersect_rect(a, b):
+    """
+    Returns the intersection of two (top, left, bottom, right) rectangles, or None if either is None or they do not overlap.
+    """
+    if a is None or b is None:
+        return None
+    rect = (max(a[0], b[0]), max(a[1], b[1]), min(a[2], b[2]), min(a[3], b[3]))
+    return rect if rect[0] < rect[2] and rect[1] < rect[3] else None
+
+def union_rect(a, b):
+    """
+    Returns the bounding rectangle of two (top, left, bottom, right) rectangles, where None stands for an empty one.
+    """
+    if a is None:
+        return b
+    if b is None:
+        return a
+    return (min(a[0], b[0]), min(a[1], b[1]), max(a[2], b[2]), max(a[3], b[3]))
+
+def offset_rect(rect, top, left):
+    """
+    Moves a (top, left, bottom, right) rectangle by the given offsets. None stays None.
+    """
+    return None if rect is None else (rect[0] + top, rect[1] + left, rect[2] + top, rect[3] + left)
+
+def parts_shape(parts):
+    """
+    Returns the (height, width, channels) shape of the frame tiled by a list of (image, top, left) parts.
+    """
+    return (max(top + image.shape[0] for image, top, left in parts),
+            max(left + image.shape[1] for image, top, left in parts),
+            parts[0][0].shape[2])
+
+def next_frame_into(source, out):
+    """
+    Writes the next frame of a source into a caller-provided buffer and returns the buffer.
+    Sources whose next_frame does not accept an out buffer, such as older custom subclasses, are supported by copying their frame.
+
+    Parameters:
+        source (Source): The source to pull the frame from.
+        out (np.ndarray): The BGRA buffer written, with the shape of the frames of the source.
+
+    Returns:
+        np.ndarray: The out buffer.
+    """
+    accepts_out = _accepts_out.get(type(source))
+    if accepts_out is None:
+        accepts_out = 'out' in inspect.signature(source.next_frame).parameters
+        _accepts_out[type(source)] = accepts_out
+    if accepts_out:
+        return source.next_frame(out=out)
+    np.copyto(out, source.next_frame())
+    return out
+
+# Whether the next_frame method of each Source class accepts an out buffer
+_accepts_out = dict()
+
 class Source:
+    # Sources that track their content keep a counter of it, None means every frame must be considered new
+    _version = None
+    _rect = None
+    # Buffer reused to convert BGR frames to BGRA
+    _bgra = None
+
+    # The saturation used as chroma key when blending with CHROMA_KEYING, None to detect it from the frames
+    chroma_color = None
+
     def blending_strategy(self):
         return self.blending
 
-    def next_frame(self):
+    def is_static(self):
+        """
+        Returns True if every frame of this source is the same until it is reset.
+        """
+        return False
+
+    def children(self):
+        """
+        Returns the sources this source pulls its frames from.
+        """
+        return []
+
+    def frame_version(self):
+        """
+        Returns a counter identifying the content of the last frame returned by next_frame.
+        It changes whenever the content may have changed, so equal versions mean equal frames.
+
+        Returns:
+            int: The version of the last frame, or None if this source does not track it.
+        """
+        return self._version
+
+    def changed_rect(self):
+        """
+        Returns the area that changed between the previous version of this source and the current one.
+        It is only meaningful when the version went up by exactly one since the caller last saw it.
+
+        Returns:
+            tuple: The changed area as (top, left, bottom, right), or None if the whole frame may have changed.
+        """
+        return self._rect
+
+    def _changed(self, rect=None):
+        """
+        Marks the content of this source as changed, optionally only within the given (top, left, bottom, right) rectangle.
+        """
+        self._version = 0 if self._version is None else self._version + 1
+        self._rect = rect
+
+    def _changed_area(source, version, last_version, shape):
+        """
+        Returns the area of a source that changed since a consumer last saw it at last_version.
+
+        Returns:
+            tuple: The changed area as (top, left, bottom, right), the whole frame if unknown, or None if nothing changed.
+        """
+        if version is not None and version == last_version:
+            return None
+        if version is None or last_version is None or version != last_version + 1 or source.changed_rect() is None:
+            return (0, 0, shape[0], shape[1])
+        return source.changed_rect()
+
+    def next_frame(self, out=None):
         """
         Computes as necessary and returns the next frame in the source.
+        The returned array may be reused by the source for later frames and must not be modified by the caller.
+
+        Parameters:
+            out (np.ndarray): A buffer with the shape of the frame, into which the frame is written. Default is None.
 
         Returns:
-            np.ndarray: The next frame in the source as an array with shape (height, width, color_channel)
+            np.ndarray: The next frame in the source as an array with shape (height, width, color_channel), out if given.
         """
         frame = self._next_frame()
-        return cv2.cvtColor(frame, cv2.COLOR_BGR2BGRA) if frame.shape[2] == 3 else frame
+        if frame.shape[2] == 3:
+            if out is not None:
+                return cv2.cvtColor(frame, cv2.COLOR_BGR2BGRA, dst=out)
+            if self._bgra is None or self._bgra.shape[:2] != frame.shape[:2]:
+                self._bgra = np.empty(frame.shape[:2] + (4,), frame.dtype)
+            return cv2.cvtColor(frame, cv2.COLOR_BGR2BGRA, dst=self._bgra)
+        return Source._write(frame, out)
+
+    def next_parts(self):
+        """
+        Advances the source like next_frame, and returns the frame as a list of (image, top, left) parts that tile it.
+        Consumers that process pixels independently can use the parts as they are instead of having the frame assembled.
+        Like frames, the parts must not be modified by the caller.
+
+        Returns:
+            list: The parts of the next frame, as views of arrays kept by the source where possible.
+        """
+        return [(self.next_frame(), 0, 0)]
+
+    def next_frames(self, n, out=None):
+        """
+        Advances the source by n frames and returns them as a single block, so that the per frame overhead of
+        nested sources is paid once per batch. Static sources repeat their frame without pulling it again,
+        and runs of frames with the same version are written at once.
+        Afterwards, frame_version identifies the last frame of the block. Like frames, the block must not be modified by the caller.
+
+        Parameters:
+            n (int): The amount of frames, at least 1.
+            out (np.ndarray): A buffer with shape (n, height, width, 4), into which the frames are written. Default is None.
+
+        Returns:
+            np.ndarray: The frames as an array with shape (n, height, width, 4), out if given.
+        """
+        frame = self.next_frame()
+        if self.is_static():
+            return Source._write_frames(frame, n, out)
+
+        if out is None:
+            out = np.empty((n,) + frame.shape, frame.dtype)
+        out[0] = frame
+        start = 0
+        version = self.frame_version()
+        for i in range(1, n):
+            frame = self.next_frame()
+            if version is not None and self.frame_version() == version:
+                continue
+            out[start + 1:i] = out[start]
+            out[i] = frame
+            start = i
+            version = self.frame_version()
+        out[start + 1:n] = out[start]
+        return out
+
+    def _compose_frames(out, bg_images, layers):
+        """
+        Composes a block of frames from a block of backgrounds and the blocks of the layers blended over them.
+        Blocks that repeat a single frame, such as those of static sources, are composed on the first frame only,
+        as long as everything below them repeats too, and the result is copied to the other frames.
+
+        Parameters:
+            out (np.ndarray): The block written, with the shape of the backgrounds.
+            bg_images (np.ndarray): The block of backgrounds.
+            layers (list): The (blender, images, top, left) of every layer, from bottom to top.
+        """
+        # Repeated frames are broadcast views, with no stride between frames
+        repeated = bg_images.strides[0] == 0
+        if repeated:
+            np.copyto(out[0], bg_images[0])
+        else:
+            out[:] = bg_images
+        for blender, images, top, left in layers:
+            if repeated and images.strides[0] == 0:
+                blender.blend_frames(out[:1], images[:1], top, left)
+                continue
+            if repeated:
+                out[1:] = out[0]
+                repeated = False
+            blender.blend_frames(out, images, top, left)
+        if repeated:
+            out[1:] = out[0]
+        return out
+
+    def _write_frames(frame, n, out):
+        """
+        Returns a block repeating the frame n times, as a read-only view when no buffer is given.
+        """
+        if out is None:
+            return np.broadcast_to(frame, (n,) + frame.shape)
+        out[:] = frame
+        return out
+
+    def _write(frame, out):
+        """
+        Returns the frame, or copies it into out and returns out when a buffer is given.
+        """
+        if out is None:
+            return frame
+        np.copyto(out, frame)
+        return out
 
     def reset(self, producst):
         pass
 
+    def seek(self, index):
+        """
+        Positions the source so that the next call to next_frame returns the frame at the given index,
+        counted from the last reset. Frames are deterministic, so seeking gives the same frames as playing up to the index.
+
+        Parameters:
+            index (int): The index of the next frame.
+
+        Raises:
+            NotImplementedError: If the source does not support random access.
+        """
+        raise NotImplementedError(f"{type(self).__name__} does not support seeking")
+
+    def frame_at(self, index):
+        """
+        Returns the frame at the given index, counted from the last reset, and leaves the source positioned after it.
+        """
+        self.seek(index)
+        return self.next_frame()
+
     def _next_frame(self):
         pass
 
@@ -40,84 +284,258 @@ class Source:
         valid_extensions = {'.jpg', '.jpeg', '.png', '.gif', '.bmp'}
         return any(video_path.lower().endswith(ext) for ext in valid_extensions)
 
+    def _load_image(path, resolution):
+        """
+        Reads an image rescaled to the given resolution as BGRA, going through the process-wide asset cache.
+        The returned array is shared and must not be modified.
+        """
+        def load():
+            img = cv2.imread(path, cv2.IMREAD_UNCHANGED)
+            img = cv2.resize(img, resolution)
+            return cv2.cvtColor(img, cv2.COLOR_BGR2BGRA) if img.shape[2] == 3 else img
+
+        return asset_cache.get(path, resolution, 'bgra', load)
+
 
 class SingleMediaSource(Source):
     """
     A class used to represent a single creative asset, with no added modification or effects.
-    This class handles both image and video inputs and allows for frame skipping to reach a desired fps for videos.
+    This class handles both image and video inputs and maps every output frame to a video frame to reach a desired fps for videos,
+    at any rational ratio between both rates. Video frames that are never shown are decoded but neither converted nor kept.
     It also provides an option to loop the video from the beginning or freeze on the last frame when it ends.
+    Videos can either be fully decoded up front or, in streaming mode, decoded lazily through a small ring buffer.
     """
 
-    def __init__(self, video_path, resolution=(720, 720), target_fps=None, on_end_loop=True, blending=None):
+    # The assumed amount of frames between keyframes of a streamed video until two of them were decoded, the libx264 default
+    KEYFRAME_INTERVAL = 250
+
+    def __init__(self, video_path, resolution=(720, 720), target_fps=None, on_end_loop=True, blending=None, streaming=False, buffer_size=8, disk_cache=True, chroma_color=None, frame_step=1):
         """
         The constructor for SingleMediaSource class.
 
         Parameters:
             video_path (str): Path to the video or image file.
             resolution (tuple): The desired resolution to which the asset is rescaled. Default is (720, 720).
-            target_fps (int): The desired frames per second for video assets. Default is 60.
+            target_fps (int): The desired frames per second for video assets. If None, every video frame is shown once per output frame. Default is None.
             on_end_loop (bool): If True, loops the video from the beginning when it ends. If False, freezes on the last frame. Default is True.
             blending (Blending): The strategy for blending this source into the background. Options are: None, ALPHA and CHROMA_KEYING. Default is None.
+            streaming (bool): If True, video frames are decoded on demand instead of all at construction time. Default is False.
+            buffer_size (int): The amount of decoded frames kept in memory when streaming. Default is 8.
+            disk_cache (bool): If True, decoded frames are stored on disk and memory-mapped on later runs instead of decoded again. Ignored when streaming. Default is True.
+            chroma_color (int): The HSV saturation of the chroma key for CHROMA_KEYING blending. If None, the most common saturation of the first frame is used. Default is None.
+            frame_step (float): The amount of frames the video advances by each output frame, e.g. 4 to keep its speed in a preview rendered at a quarter of the frame rate. Default is 1.
         """
         super().__init__()
+        self.video_path = video_path
+        self.frame_step = frame_step
         self.target_fps = target_fps
+        self.resolution = resolution
+        self.streaming = streaming
         if Source._known_image_extension(video_path):
             self.container = None
             self.source_fps = target_fps
             self.target_fpa = target_fps
-            self.fps_factor = 1
-            self.last_frame = cv2.imread(video_path, cv2.IMREAD_UNCHANGED)
-            self.last_frame = cv2.resize(self.last_frame, resolution)
+            self.rate = Fraction(1)
+            self.last_frame = Source._load_image(video_path, resolution)
+            self._changed()
         else:
             self.container = av.open(video_path)
             video_stream = self.container.streams.video[0]
-
-            self.frames = []
-            for frame in self.container.decode(video=0):
-                if frame.format.name != 'argb':
-                    frame = frame.reformat(resolution[0], resolution[1], 'argb')
-                    frame = frame.to_ndarray()
-                    b,g,r,a = cv2.split(frame)
-                    frame = cv2.merge((a,r,g,b))
-                else:
-                    frame = frame.to_ndarray()
-                self.frames.append(frame)
-            self.total_frames = video_stream.frames
             self.source_fps =  int(video_stream.average_rate)
+            # The amount of video frames the video advances by each output frame
+            self.rate = Fraction(frame_step).limit_denominator(1000)
+            if target_fps is not None:
+                self.rate *= Fraction(video_stream.average_rate) / Fraction(target_fps).limit_denominator(1000)
+
+            if streaming:
+                # Frames [next_index - len(buffer), next_index) are kept in memory
+                self.frames = None
+                self.buffer = deque(maxlen=max(1, buffer_size))
+                self.keyframe_interval = None
+                self._rewind()
+            else:
+                # Only the frames that are shown are kept, so the decoded frames depend on the rate when it skips frames
+                decode = lambda: (self._convert(frame) for index, frame in enumerate(self.container.decode(video=0)) if self._is_shown(index))
+                pixel_format = 'bgra' if self.rate <= 1 else f'bgra-{self.rate.numerator}-{self.rate.denominator}'
+                # The amount of kept frames, if the container reports its length
+                count = -(-video_stream.frames // self.rate) if self.rate > 1 else video_stream.frames
+                if disk_cache:
+                    load = lambda: frame_store.load(video_path, resolution, pixel_format, decode, count)
+                else:
+                    load = lambda: list(decode())
+                self.frames = asset_cache.get(video_path, resolution, pixel_format, load)
+                if len(self.frames) == 0:
+                    raise ValueError(f"No frames could be decoded from \"{video_path}\"")
             self.target_fps = target_fps
-            self.fps_factor = 1 if target_fps is None else int(self.target_fps / self.source_fps)
             self.last_frame = None
+            if streaming:
+                self.total_frames = video_stream.frames
+                if self.total_frames <= 0:
+                    # Unknown length, the end is found once the decoder runs out of frames
+                    self.total_frames = float('inf')
+                self.step = self.rate
+            else:
+                # Only shown frames are kept, so an output frame advances by at most one of them
+                self.total_frames = len(self.frames)
+                self.step = min(self.rate, 1)
+            self._build_timeline()
 
-        self.resolution = resolution
         self.count = 0
+        self.frame_index = None
         self.ret = True
         self.on_end_loop = on_end_loop
         self.blending = blending
+        self.chroma_color = chroma_color
+
+    def is_static(self):
+        return self.container is None
 
     def reset(self, products):
         if self.container != None:
             self.count = 0
+            self.frame_index = None
             self.last_frame = None
 
+    def seek(self, index):
+        if self.container != None:
+            self.count = index
+            self.frame_index = None
+
+    def _convert(self, frame):
+        """
+        Converts a decoded PyAV frame into a BGRA array with the target resolution.
+        This is the only place frames are resized, so every shown frame is resized once.
+        """
+        frame = frame.reformat(self.resolution[0], self.resolution[1], 'argb')
+        frame = frame.to_ndarray()
+        b,g,r,a = cv2.split(frame)
+        return cv2.merge((a,r,g,b))
+
+    def _is_shown(self, index):
+        """
+        Returns True if the video frame at the given index is shown by some output frame.
+        When the rate skips frames, the frame is shown if the first output frame that reaches it does not already skip past it.
+        """
+        if self.rate <= 1:
+            return True
+        count = -(-index * self.rate.denominator // self.rate.numerator)
+        return count * self.rate.numerator // self.rate.denominator == index
+
+    def _build_timeline(self):
+        """
+        Precomputes the frame shown at every output frame of one pass through the video, as indexes into its frames,
+        or into the kept frames when they were decoded up front. Videos of unknown length are mapped on the fly.
+        """
+        if self.total_frames == float('inf'):
+            self.timeline = None
+            return
+        # The pass ends at the first output frame past the last frame
+        length = max(1, -(-self.total_frames * self.step.denominator // self.step.numerator))
+        self.timeline = np.arange(length, dtype=np.int64) * self.step.numerator // self.step.denominator
+
+    def _rewind(self):
+        """
+        Seeks the container back to its first frame and drops every buffered frame.
+        """
+        self.container.seek(0)
+        self.decoder = self.container.decode(video=0)
+        self.buffer.clear()
+        self.next_index = 0
+        self.last_keyframe = None
+
+    def _seek_container(self, index):
+        """
+        Seeks the container to the closest keyframe before the given frame index and decodes the frame found there.
+        Falls back to rewinding when timestamps are unavailable or the seek overshoots.
+        """
+        stream = self.container.streams.video[0]
+        if index == 0 or stream.time_base is None or not stream.average_rate:
+            self._rewind()
+            return
+
+        start = stream.start_time or 0
+        self.container.seek(start + int(index / (stream.average_rate * stream.time_base)), stream=stream, backward=True)
+        self.decoder = self.container.decode(stream)
+        self.buffer.clear()
+
+        frame = next(self.decoder, None)
+        if frame is None or frame.pts is None:
+            self._rewind()
+            return
+        frame_index = round((frame.pts - start) * stream.time_base * stream.average_rate)
+        if frame_index > index:
+            self._rewind()
+            return
+
+        self.last_keyframe = None
+        self._decoded(frame, frame_index)
+
+    def _decoded(self, frame, index):
+        """
+        Appends a frame decoded at the given index to the buffer, and measures the interval between the keyframes decoded.
+        Frames that are never shown keep their place in the buffer without being converted.
+        """
+        if frame.key_frame:
+            if self.last_keyframe is not None:
+                self.keyframe_interval = max(self.keyframe_interval or 0, index - self.last_keyframe)
+            self.last_keyframe = index
+        self.buffer.append(self._convert(frame) if self._is_shown(index) else None)
+        self.next_index = index + 1
+
+    def _frame(self, index):
+        """
+        Returns the frame at the given index of the video, or None if the video has less frames.
+        When streaming, frames are decoded as needed. The container is seeked for indexes that already left the buffer,
+        or that are further ahead than a keyframe interval, since closer ones are reached sooner by decoding forward.
+        """
+        if self.frames is not None:
+            return self.frames[index] if index < len(self.frames) else None
+
+        interval = self.keyframe_interval or SingleMediaSource.KEYFRAME_INTERVAL
+        if index < self.next_index - len(self.buffer) or index >= self.next_index + max(self.buffer.maxlen, interval):
+            self._seek_container(index)
+
+        while index >= self.next_index:
+            frame = next(self.decoder, None)
+            if frame is None:
+                return None
+            self._decoded(frame, self.next_index)
+
+        return self.buffer[index - self.next_index + len(self.buffer)]
+
+    def _source_index(self, count):
+        """
+        Returns the index of the frame shown at the given output frame, from the precomputed timeline.
+        Past the end the video either loops from the start or holds its last shown frame.
+        """
+        if self.timeline is None:
+            return count * self.step.numerator // self.step.denominator
+        if self.on_end_loop:
+            return int(self.timeline[count % len(self.timeline)])
+        return int(self.timeline[min(count, len(self.timeline) - 1)])
+
     def _next_frame(self):
         """
         Adjusts the frame rate of the video to the desired fps and returns the next frame in the source.
         """
 
         if self.container:
-            if self.count % self.fps_factor != 0:
-                self.count += 1
-                return self.last_frame
-
-            if self.count >= self.total_frames and self.on_end_loop:
-                self.count = 0
-                self.last_frame = self.frames[0]
-            elif self.count < self.total_frames:
-                frame = self.frames[self.count]
+            index = self._source_index(self.count)
+            if index != self.frame_index:
+                frame = self._frame(index)
+                if frame is None:
+                    # The container reported more frames than it could decode
+                    self.total_frames = self.next_index
+                    self._build_timeline()
+                    index = self._source_index(self.count)
+                    frame = self._frame(index)
+
+                self.frame_index = index
+                # Decoded frames already have the target resolution and are used as they are
                 self.last_frame = frame
+                self._changed()
 
             self.count += 1
-            self.last_frame = cv2.resize(self.last_frame, self.resolution)
 
         return self.last_frame
 
@@ -152,6 +570,9 @@ class ImageSlideshowSource(Source):
         self.on_end_loop = on_end_loop
         self.target_fps = target_fps
         self.count = 0
+        self.frame = None
+        self.block = None
+        self.pair = None
 
         self.left_bound_white = left_bound_white
         self.right_bound_white = right_bound_white
@@ -162,9 +583,7 @@ class ImageSlideshowSource(Source):
             self.reset(img_paths)
 
     def reset(self, products):
-        self.imgs = [cv2.imread(path, cv2.IMREAD_UNCHANGED) for path in products]
-        self.imgs = [cv2.resize(img, self.dimensions) for img in self.imgs]
-        self.imgs = [(cv2.cvtColor(img, cv2.COLOR_BGR2BGRA) if img.shape[2] == 3 else img) for img in self.imgs]
+        self.imgs = [Source._load_image(path, self.dimensions) for path in products]
 
         expected_imgs = 1 + int(self.min_time / (self.standby_time+self.transition_time))
         if not self.on_end_loop:
@@ -179,57 +598,150 @@ class ImageSlideshowSource(Source):
         if self.right_bound_white:
             self.imgs = self.imgs + [white_img]
 
-        self.is_transitioning = True
-        self.state_count = 0
-        self.next_img_idx = 0
+        self.count = 0
+        self.frame_key = None
+        self.pair = None
+
+    def seek(self, index):
+        self.count = index
+        self.frame_key = None
 
     def _left_transition(img1, img2, alpha):
         """
-            This function performs a left transition between two images.
+            This function splits a left transition between two images into the parts that form it, without copying them.
             Parameters:
                 img1 (numpy array): The first image.
                 img2 (numpy array): The second image.
                 alpha (float): The transition factor, float between 0 and 1. The higher the value, the more of the second image will be visible.
             Returns:
-                numpy array: The resulting image after performing the left transition. Same as input shape of both images.
+                list: The visible part of each image as (view, top, left), tiling an image of the same shape as both inputs.
         """
 
         if img1.shape != img2.shape:
             raise ValueError("Input images must be of the same shape.")
 
         cut = int(alpha * img1.shape[1])
-        res = np.zeros_like(img1)
-        res[:, :img1.shape[1]-cut] = img1[:, cut:]
-        res[:, img1.shape[1]-cut:] = img2[:, :cut]
-        return res
+        return [(img1[:, cut:], 0, 0), (img2[:, :cut], 0, img1.shape[1]-cut)]
 
-    def _next_frame(self):
+    def _state(self, count):
         """
-        Returns the next frame in the slideshow.
+        Returns the state of the slideshow at the given frame, in closed form.
+        Each cycle starts with a transition towards the next image, followed by a standby on it, and stops advancing at the last image.
+
+        Returns:
+            tuple: The index of the current image, and the transition factor towards the next one or None when standing by.
+        """
+        transition = self.transition_time * self.target_fps
+        standby = self.standby_time * self.target_fps
+        cycle, step = divmod(count, transition + standby)
+        cycle = int(cycle)
+
+        if step < transition:
+            idx = min(cycle, len(self.imgs) - 1)
+            if idx < len(self.imgs) - 1:
+                return (idx, (step + 1) / transition)
+            return (idx, None)
+        return (min(cycle + 1, len(self.imgs) - 1), None)
+
+    def next_parts(self):
+        """
+        Returns the next frame in the slideshow as parts of its images.
         This method handles the transitions between images and the standby time for each image.
         """
         if self.imgs == None:
             raise ValueError("No Images Set")
 
-        # Simple state machine to control the transition between images
-        if self.is_transitioning and self.state_count == self.transition_time * self.target_fps:
-            self.state_count = 0
-            self.is_transitioning = False
-            self.next_img_idx = min(self.next_img_idx + 1, len(self.imgs) - 1)
-
+        idx, cut, alpha = self._key(self.count)
+        self.count += 1
 
-        if not self.is_transitioning and self.state_count == self.standby_time * self.target_fps:
-            self.state_count = 0
-            self.is_transitioning = True
+        # Standby frames keep the same version
+        if (idx, cut) != self.frame_key:
+            self.frame_key = (idx, cut)
+            self._changed()
 
+        if cut == 0:
+            return [(self.imgs[idx], 0, 0)]
+        return ImageSlideshowSource._left_transition(self.imgs[idx], self.imgs[idx + 1], alpha)
 
-        self.count += 1
-        self.state_count += 1
+    def next_frames(self, n, out=None):
+        """
+        Returns the next n frames of the slideshow as a block. Standby frames are repeated from their image, and the
+        frames of a transition are copied from a view of every cut of the two images placed side by side.
+        """
+        if self.imgs == None:
+            raise ValueError("No Images Set")
 
-        if self.is_transitioning and self.next_img_idx < len(self.imgs) - 1:
-            alpha = self.state_count / (self.transition_time * self.target_fps)
-            frame = ImageSlideshowSource._left_transition(self.imgs[self.next_img_idx], self.imgs[self.next_img_idx + 1], alpha)
-        else:
-            frame = self.imgs[self.next_img_idx]
+        keys = [self._key(self.count + i)[:2] for i in range(n)]
+        self.count += n
+        for key in keys:
+            if key != self.frame_key:
+                self.frame_key = key
+                self._changed()
+
+        # A single image, or a single step of a transition, is repeated without copies
+        if out is None and keys[0] == keys[-1]:
+            idx, cut = keys[0]
+            frame = self.imgs[idx] if cut == 0 else self._cuts(idx)[cut]
+            return Source._write_frames(frame, n, None)
+
+        if out is None:
+            if self.block is None or self.block.shape != (n,) + self.imgs[0].shape:
+                self.block = np.empty((n,) + self.imgs[0].shape, self.imgs[0].dtype)
+            out = self.block
+
+        start = 0
+        while start < n:
+            idx, cut = keys[start]
+            end = start + 1
+            # Runs of standby frames on an image, or of frames of the same transition
+            while end < n and keys[end][0] == idx and (keys[end][1] == 0) == (cut == 0):
+                end += 1
+            if cut == 0:
+                out[start:end] = self.imgs[idx]
+            else:
+                # Frames are copied one by one, since gathering them from the strided view at once is far slower
+                windows = self._cuts(idx)
+                for i in range(start, end):
+                    np.copyto(out[i], windows[keys[i][1]])
+            start = end
+        return out
+
+    def _key(self, count):
+        """
+        Returns the image, the column where the next image starts and the transition factor of the frame at the given count.
+        Transitions that show a single image are normalized to standing by on it, with a cut of 0.
+        """
+        idx, alpha = self._state(count)
+        cut = 0 if alpha is None else int(alpha * self.imgs[idx].shape[1])
+        if cut == self.imgs[idx].shape[1]:
+            idx, cut = idx + 1, 0
+        return idx, cut, alpha
 
-        return frame
+    def _cuts(self, idx):
+        """
+        Returns a read-only view of every frame of the transition from an image to the next one, indexed by cut.
+        The frame at cut c is the window starting at column c of both images placed side by side.
+        """
+        if self.pair is None or self.pair[0] != idx:
+            self.pair = (idx, np.concatenate((self.imgs[idx], self.imgs[idx + 1]), axis=1))
+        pair = self.pair[1]
+        height, width = self.imgs[idx].shape[:2]
+        return np.lib.stride_tricks.as_strided(pair, shape=(width + 1, height, width, pair.shape[2]),
+                strides=(pair.strides[1],) + pair.strides, writeable=False)
+
+    def next_frame(self, out=None):
+        """
+        Returns the next frame in the slideshow. Images are normalized to BGRA when they are loaded,
+        so standby frames are returned as they are and transitions are assembled from their parts.
+        """
+        parts = self.next_parts()
+        if len(parts) == 1:
+            return Source._write(parts[0][0], out)
+
+        if out is None:
+            if self.frame is None or self.frame.shape != self.imgs[0].shape:
+                self.frame = np.empty_like(self.imgs[0])
+            out = self.frame
+        for image, top, left in parts:
+            out[top:top + image.shape[0], left:left + image.shape[1]] = image
+        return out
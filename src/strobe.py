@@ -3,13 +3,27 @@
 #  This source code is licensed under the license found in the
 #  LICENSE file in the root directory of this source tree.
 
-from source import Blending,Source
+from source import Blending,Source,union_rect
 
 import cv2
 import numpy as np
 
 class StrobeSource(Source):
-    def __init__(self, source, min_scale, start_scale, start_speed, start_direction=-1, centered=True, on_end_loop=True):
+    def __init__(self, source, min_scale, start_scale, start_speed, start_direction=-1, centered=True, on_end_loop=True, quantization=None, cache_bytes=64 * 1024 * 1024):
+        """
+        The constructor for StrobeSource class.
+
+        Parameters:
+            source (Source): The Source whose frames are scaled.
+            min_scale (float): The smallest scale, between 0.01 and 1.
+            start_scale (float): The scale of the first frame. Values outside [0, 1) start at 1.
+            start_speed (float): The change of the scale per frame, between 0.0001 and 0.1.
+            start_direction (int): -1 to start shrinking, 1 to start growing. Default is -1.
+            centered (bool): If True, scaled frames are centered, otherwise they are placed at the top left corner. Default is True.
+            on_end_loop (bool): If True, the scale bounces between its bounds. If False, it stops at the first bound reached. Default is True.
+            quantization (float): If set, scales are rounded to multiples of this step, so that fewer distinct sizes are rendered. Default is None.
+            cache_bytes (int): The memory budget for scaled frames kept when the source is static, so that each scale is only resized once. Default is 64MB.
+        """
         self.source = source
         if self.source.blending_strategy() != Blending.ALPHA and source.blending_strategy() != None:
             print("Strobing requires Alpha Blending")
@@ -20,44 +34,154 @@ class StrobeSource(Source):
         self.direction = -1 if start_direction < 0 else 1
         self.centered = centered
         self.on_end_loop = on_end_loop
+        self.quantization = quantization
+        self.cache_bytes = cache_bytes
+        self.scaled = dict()
+        self.scaled_bytes = 0
         self.last_frame = None
+        self.frame_key = None
+        self.footprint = None
+        self.canvas = None
+        self.reduced = None
 
         self.starting_params = (self.scale, self.speed, self.direction)
+        self.count = 0
+        self._schedule()
 
     def blending_strategy(self):
         return Blending.ALPHA
 
+    def children(self):
+        return [self.source]
+
     def reset(self, products):
         self.source.reset(products)
+        self.scaled.clear()
+        self.scaled_bytes = 0
         self.scale, self.speed, self.direction = self.starting_params
+        self.count = 0
         self.last_frame = None
+        self.frame_key = None
+        self.footprint = None
+        self.canvas = None
+
+    def seek(self, index):
+        # Once frozen, the source is no longer pulled
+        self.source.seek(index if self.freeze is None else min(index, self.freeze))
+        self.count = index
+        self.last_frame = None
+        self.frame_key = None
+        self.footprint = None
+        self.canvas = None
+
+    def _schedule(self):
+        """
+        Computes the scale of every frame once. The scale moves by the speed each frame and bounces between
+        the minimal scale and 1 when looping, so the schedule is a prefix up to the first bounce followed by a repeating cycle.
+        Without looping, the scale freezes at the first bound it reaches. Quantization is applied once the trajectory is known.
+        """
+        scale, speed, direction = self.starting_params
+        self.scales = []
+        self.cycle_start = None
+        self.freeze = None
+
+        first_bounce = None
+        while True:
+            if (
+                    (direction == -1 and scale == self.min_scale) or
+                    (direction == 1 and scale == 1)
+                ):
+                if first_bounce is None:
+                    first_bounce = (len(self.scales), scale, direction)
+                elif (scale, direction) == first_bounce[1:]:
+                    self.cycle_start = first_bounce[0]
+                    break
+                direction = -direction if self.on_end_loop else 0
+
+            scale = max(self.min_scale, min(scale + (direction * speed), 1))
+            self.scales.append(scale)
+            if direction == 0:
+                self.freeze = len(self.scales) - 1
+                break
+
+        if self.quantization:
+            step = self.quantization
+            self.scales = [max(self.min_scale, min(round(scale / step) * step, 1)) for scale in self.scales]
+
+    def _scale_at(self, index):
+        if self.freeze is not None:
+            return self.scales[min(index, self.freeze)]
+        if index < len(self.scales):
+            return self.scales[index]
+        return self.scales[self.cycle_start + (index - self.cycle_start) % (len(self.scales) - self.cycle_start)]
+
+    def _resize(self, frame):
+        """
+        Returns the frame resized to the current scale.
+        Frames of static sources are kept per scale until the memory budget is full, so that repeated scales are only copied.
+        Scales repeat in cycles, where evicting the least recently used one would always evict the next one needed.
+        """
+        if not self.source.is_static():
+            # Resized into a contiguous prefix of a buffer that fits any scale, so that it is allocated once
+            height = max(1, round(frame.shape[0] * self.scale))
+            width = max(1, round(frame.shape[1] * self.scale))
+            if self.reduced is None or self.reduced.size < frame.size:
+                self.reduced = np.empty(frame.size, frame.dtype)
+            reduced = self.reduced[:height * width * frame.shape[2]].reshape(height, width, frame.shape[2])
+            return cv2.resize(frame, (0,0), dst=reduced, fx=self.scale, fy=self.scale)
+
+        if self.scale in self.scaled:
+            return self.scaled[self.scale]
 
-    def next_frame(self):
-        if self.direction == 0:
-            return self.last_frame
-
-        if (
-                (self.direction == -1 and self.scale == self.min_scale) or
-                (self.direction == 1 and self.scale == 1)
-            ):
-            self.direction = -self.direction if self.on_end_loop else 0
-
-        self.scale = max(self.min_scale, min(self.scale + (self.direction * self.speed), 1))
+        reduced = cv2.resize(frame, (0,0), fx=self.scale, fy=self.scale)
+        if self.scaled_bytes + reduced.nbytes <= self.cache_bytes:
+            self.scaled[self.scale] = reduced
+            self.scaled_bytes += reduced.nbytes
+        return reduced
+
+    def next_frame(self, out=None):
+        index = self.count
+        self.count += 1
+        if self.freeze is not None and index > self.freeze:
+            if self.last_frame is not None:
+                return Source._write(self.last_frame, out)
+            # After seeking past the freeze, the frozen frame is rendered once
+            index = self.freeze
+
+        self.scale = self._scale_at(index)
 
         frame = self.source.next_frame()
-        reduced = cv2.resize(frame, (0,0), fx=self.scale, fy=self.scale)
+        frame_key = (self.scale, self.source.frame_version())
+        if self.canvas is not None and frame_key[1] is not None and frame_key == self.frame_key:
+            # Neither the scale nor the strobed source changed
+            if index == self.freeze:
+                self.last_frame = self.canvas
+            return Source._write(self.canvas, out)
+
+        reduced = self._resize(frame)
 
         margin = (0,0) if not self.centered else ((
                     int((frame.shape[0] - reduced.shape[0])/2),
                     int((frame.shape[1] - reduced.shape[1])/2)
                 ))
 
-
-        frame = np.zeros_like(frame)
-        frame[margin[0]:margin[0]+reduced.shape[0],
-              margin[1]:margin[1]+reduced.shape[1]] = reduced
-
-        if self.direction == 0:
-            self.last_frame = frame
-
-        return frame
+        # The output only changes with the scale or the content of the strobed source.
+        # When only the scale changed, the change is limited to the previous and current footprints.
+        footprint = (margin[0], margin[1], margin[0] + reduced.shape[0], margin[1] + reduced.shape[1])
+        same_source = self.frame_key is not None and frame_key[1] == self.frame_key[1]
+        self._changed(union_rect(self.footprint, footprint) if same_source else None)
+        self.frame_key = frame_key
+
+        # The canvas is retained, so only the previous footprint is cleared
+        if self.canvas is None or self.canvas.shape != frame.shape:
+            self.canvas = np.zeros_like(frame)
+        elif self.footprint is not None:
+            self.canvas[self.footprint[0]:self.footprint[2], self.footprint[1]:self.footprint[3]] = 0
+        self.footprint = footprint
+        self.canvas[margin[0]:margin[0]+reduced.shape[0],
+                    margin[1]:margin[1]+reduced.shape[1]] = reduced
+
+        if index == self.freeze:
+            self.last_frame = self.canvas
+
+        return Source._write(self.canvas, out)
@@ -1,15 +1,30 @@
+import argparse
 import csv
+import cv2
+import io
+import numpy as np
+import os
+import shutil
+import tempfile
+import traceback
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, as_completed, wait
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import redirect_stdout
 from os import listdir
 from os.path import exists, isdir, isfile, join
-from sys import argv
 from combinator import MarginCombinator
 from controller import Controller
+from manifest import Manifest
+from plan import compile_plan
+from prefetch import Prefetcher
+from profiler import Profiler
 from source import Blending, Source, SingleMediaSource, ImageSlideshowSource
 from sink import Sink
 from enum import Enum, StrEnum, IntEnum
 from strobe import StrobeSource
 
-fps = 60
+# The frame rate templates are designed for. Durations are in seconds, but effects and videos advance per frame at this rate
+template_fps = 60
 
 class Video:
     class VType(StrEnum):
@@ -49,8 +64,40 @@ class Video:
         SLOW = 0.0005,
         VERY_SLOW = 0.0001
 
-    def __init__(self, target_directory):
+    # Times a product or segment is rendered on its own before giving up when its worker process crashes
+    MAX_ATTEMPTS = 3
+
+    # Bumped whenever a change of the renderer alters the output of existing templates, so that outputs are rendered again
+    RENDERER_VERSION = 3
+
+    def __init__(self, target_directory, queue_depth=0, prefetch_depth=1, prefetch_bytes=256 * 1024 * 1024, encoder=None,
+                 fps=template_fps, scale=1.0, max_products=None, output_directory=None, batch_size=1):
+        """
+        Parses the template of a target directory and lists its products.
+
+        Parameters:
+            target_directory (str): Directory with the template.csv file, and the template, products and output folders.
+            queue_depth (int): If positive, frames are encoded in a separate thread through a queue of this many frames. Default is 0.
+            prefetch_depth (int): The amount of upcoming products whose images are loaded while rendering, 0 to load them when each product starts. Default is 1.
+            prefetch_bytes (int): The memory budget of the images loaded ahead. Default is 256MB.
+            encoder (dict): Encoder settings passed to the Sink, such as codec, preset, crf, bit_rate, gop, pix_fmt, threads and hold.
+                They override the settings of the OUTPUT row of the template. Default is None.
+            fps (int): The frame rate of the output videos. Effects and videos keep the speed they have at the template frame rate. Default is 60.
+            scale (float): The factor applied to the output dimensions, and to the dimensions and margins of every element. Default is 1.0.
+            max_products (int): If set, only the first products, in alphabetical order, are rendered. Default is None.
+            output_directory (str): The directory of the output videos. Default is None, the output folder of the target directory.
+            batch_size (int): The amount of frames pulled from the source tree at once. Default is 1.
+        """
+        self.queue_depth = queue_depth
+        self.batch_size = batch_size
+        self.prefetch_depth = prefetch_depth
+        self.prefetch_bytes = prefetch_bytes
+        self.fps = fps
+        self.scale = scale
+        # Template frames played by each output frame
+        self.frame_step = template_fps / fps
         self.audio = None
+        self.encoder = dict()
         self.background = None
         self.dimensions = (0,0)
 
@@ -59,11 +106,14 @@ class Video:
         self.target_directory = target_directory
         self.template_directory = join(target_directory,'template')
         self.product_directory = join(target_directory,'products')
-        self.output_directory = join(target_directory,'output')
+        self.output_directory = join(target_directory,'output') if output_directory == None else output_directory
 
         print(f"1. Generating Product List from \"{self.product_directory}\"")
         self.products = self._populateProducts()
         print(f"\tProducts found: {len(self.products)}")
+        if max_products != None and len(self.products) > max_products:
+            self.products = dict(sorted(self.products.items())[:max(0, max_products)])
+            print(f"\tRendering the first {len(self.products)}")
 
         csv_filename = join(self.target_directory,'template.csv')
         if not exists(csv_filename):
@@ -75,12 +125,118 @@ class Video:
             for row in csv_reader:
                 self._parseRow(row)
 
-    def create(self):
+        if encoder != None:
+            self.encoder.update({name: value for name, value in encoder.items() if value != None})
+        if len(self.encoder) > 0:
+            print(f"\tEncoder Settings: {self.encoder}")
+
+    def create(self, workers=1, split_phases=False, chunk_seconds=None, profiler=None, force=False, dry_run=False):
+        """
+        Renders a video for every product whose output is missing or was rendered from different inputs.
+        The inputs of every output are recorded in a manifest in the output directory.
+
+        Parameters:
+            workers (int): The amount of processes rendering products in parallel. Default is 1, rendering in this process.
+            split_phases (bool): If True, the phases of each video are rendered in parallel by the workers and joined afterwards. Default is False.
+            chunk_seconds (float): When splitting phases, the maximum length of each rendered segment. Default is None, keeping phases whole.
+                The encoder's rate control restarts with each segment, so the size and quality of the output differ from an unsplit render.
+            profiler (Profiler): If set, the source tree and the encoder are instrumented with it. Only rendering in this process is profiled. Default is None.
+            force (bool): If True, every product is rendered, even if its output is up to date. Default is False.
+            dry_run (bool): If True, the products that would be rendered are listed and nothing is rendered. Default is False.
+
+        Returns:
+            dict: The error of every product that could not be rendered, indexed by output path.
+        """
+        print("3. Checking Outputs")
+        self.manifest = Manifest(join(self.output_directory, 'manifest.json'))
+        self.product_keys = self._productKeys()
+        products = {product: files for product, files in self.products.items()
+                if force or not self.manifest.is_current(product, self.product_keys[product])}
+        print(f"\tUp to date: {len(self.products) - len(products)}, to render: {len(products)}")
+
+        if dry_run:
+            for product in products:
+                reason = "missing" if not exists(product) else "forced" if self.manifest.is_current(product, self.product_keys[product]) else "changed"
+                print(f"\t{product} ({reason})")
+            return dict()
+        if len(products) == 0:
+            print("\tNothing to render")
+            return dict()
+
+        # The preview folder is not part of target directories
+        os.makedirs(self.output_directory, exist_ok=True)
+        for product in products:
+            self.manifest.forget(product)
+        try:
+            failures = self._create(products, workers, split_phases, chunk_seconds, profiler)
+        finally:
+            self.manifest.save()
+        return failures
+
+    def _create(self, products, workers, split_phases, chunk_seconds, profiler):
+        """
+        Renders the given products, recording each output in the manifest once written.
+        """
+        print("4. Composing Phases")
+        controller = self._compose()
+        if profiler != None:
+            if split_phases or workers > 1:
+                print("\tProfiling only covers rendering in this process, it is skipped with workers or split phases")
+                profiler = None
+            else:
+                profiler.instrument(controller)
+
+        print(f"5. Generating {len(products)} Videos")
+        failures = dict()
+        if split_phases:
+            failures = self._createSegmented(controller, products, max(1, workers), chunk_seconds)
+        elif workers > 1:
+            failures = self._createParallel(products, workers)
+        else:
+            # The images of the next products are loaded while the current one renders
+            with Prefetcher(controller, list(products.values()), self.prefetch_depth, self.prefetch_bytes) as prefetcher:
+                i = 1
+                for product in products:
+                    print(f"\t{i}/{len(products)}: {product}")
+                    prefetcher.advance(i - 1)
+                    if profiler != None:
+                        with profiler.span(product):
+                            stats = self._render(controller, product, products[product], profiler)
+                    else:
+                        stats = self._render(controller, product, products[product])
+                    self._rendered(product)
+                    if stats != None:
+                        print(f"\t\tEncoder queue depth {stats['queue_depth']}: "
+                              f"render waited {stats['render_stalls']} times ({stats['render_stall_time']:.2f}s), "
+                              f"encoder waited {stats['encode_stalls']} times ({stats['encode_stall_time']:.2f}s), "
+                              f"{stats['held_frames']} frames held")
+                    i += 1
+
+        for product in failures:
+            print(f"\tFailed {product}:\n{failures[product]}")
+        print("6. Done")
+        return failures
+
+    def _productKeys(self):
+        """
+        Returns the hash of the inputs of every product: the template file, the template assets, the product images,
+        the renderer version and the settings that alter the output.
+        """
+        template_files = [join(self.target_directory, 'template.csv')]
+        for directory, _, files in os.walk(self.template_directory):
+            template_files.extend(join(directory, file) for file in files)
+        template_key = self.manifest.key(template_files, dict(renderer=Video.RENDERER_VERSION, fps=self.fps, scale=self.scale, encoder=self.encoder))
+        return {product: self.manifest.key(files, template_key) for product, files in self.products.items()}
+
+    def _rendered(self, product):
+        # Outputs are only recorded once fully written
+        self.manifest.record(product, self.product_keys[product])
+
+    def _compose(self):
         base_source = None
         if 0 in self.phases and self.phases[0].source != None:
              base_source = self.phases[0].source
 
-        print("3. Composing Phases")
         controller = Controller()
 
         # Cycle through phases guaranteeing the order of the sequence
@@ -89,22 +245,148 @@ class Video:
             source = phase['source'] if base_source == None else MarginCombinator(base_source, phase['source'])
             controller.add_phase(
                     source,
-                    phase['duration'] * fps)
+                    round(phase['duration'] * self.fps))
             print(f"\tPhase {i}: {phase['duration']}")
 
-        print(f"4. Generating {len(self.products)} Videos")
-        i = 1
-        for product in self.products:
-            print(f"\t{i}/{len(self.products)}: {product}")
-            controller.reset(self.products[product])
-            sink = Sink(
-                    source = controller,
-                    target_fps = fps,
-                    time = int(controller.duration()/fps),
-                    output_video_path=product)
-            sink.create_video(self.audio)
-            i += 1
-        print("5. Done")
+        # The combinations of each phase are flattened into a single compositing pass
+        return compile_plan(controller)
+
+    def _render(self, controller, product, files, profiler=None):
+        controller.reset(files)
+        sink = Sink(
+                source = controller,
+                target_fps = self.fps,
+                time = int(controller.duration()/self.fps),
+                output_video_path=product,
+                queue_depth=self.queue_depth,
+                batch_size=self.batch_size,
+                **self.encoder)
+        if profiler != None:
+            profiler.instrument_sink(sink)
+        sink.create_video(self.audio)
+        return sink.stats
+
+    def _settings(self):
+        # Constructor arguments needed to build an identical Video in worker processes
+        return dict(queue_depth=self.queue_depth, encoder=self.encoder, fps=self.fps, scale=self.scale, output_directory=self.output_directory, batch_size=self.batch_size)
+
+    def _createParallel(self, products, workers):
+        """
+        Spreads products across a pool of processes, each building its own source tree.
+        """
+        failures = dict()
+        done = [0]
+
+        def on_done(product, error):
+            done[0] += 1
+            print(f"\t{done[0]}/{len(products)}: {product}{'' if error == None else ' (failed)'}")
+            if error != None:
+                failures[product] = error
+            else:
+                self._rendered(product)
+
+        tasks = {product: (_renderProduct, (product, products[product])) for product in products}
+        self._runPool(workers, tasks, on_done)
+        return failures
+
+    def _createSegmented(self, controller, products, workers, chunk_seconds):
+        """
+        Renders the phases, or chunks of them, of every product as separate segments in a pool of processes.
+        Once all segments of a product are encoded, they are joined without re-encoding and the audio is added.
+        """
+        frame_count = int(controller.duration()/self.fps) * self.fps
+        segments = controller.segments(frame_count, None if chunk_seconds == None else max(1, int(chunk_seconds * self.fps)))
+        print(f"\tSegments per video: {len(segments)}")
+
+        failures = dict()
+        remaining = dict.fromkeys(products, len(segments))
+        directory = tempfile.mkdtemp(prefix="segments-")
+        paths = {product: [join(directory, f"{i}-{j}.mp4") for j in range(len(segments))] for i, product in enumerate(products)}
+        done = [0]
+
+        def on_done(task, error):
+            product = task[0]
+            if error != None:
+                failures[product] = error
+            remaining[product] -= 1
+            if remaining[product] > 0:
+                return
+
+            if product not in failures:
+                try:
+                    Sink.concatenate(paths[product], product, self.audio)
+                except Exception:
+                    failures[product] = traceback.format_exc()
+            for path in paths[product]:
+                if exists(path):
+                    os.remove(path)
+            if product not in failures:
+                self._rendered(product)
+
+            done[0] += 1
+            print(f"\t{done[0]}/{len(products)}: {product}{'' if product not in failures else ' (failed)'}")
+
+        tasks = dict()
+        for product in products:
+            for j, (start, count) in enumerate(segments):
+                tasks[(product, j)] = (_renderSegment, (products[product], start, count, paths[product][j]))
+        try:
+            self._runPool(workers, tasks, on_done)
+        finally:
+            shutil.rmtree(directory, ignore_errors=True)
+        return failures
+
+    def _runPool(self, workers, tasks, on_done):
+        """
+        Runs tasks in a pool of processes, each building its own source tree, and reports each result as it finishes.
+        A crashing worker breaks the whole pool, failing every task still pending without telling which one crashed,
+        so those tasks are run again each in a pool of its own. A task is only given up on after crashing its own pool MAX_ATTEMPTS times.
+
+        Parameters:
+            workers (int): The amount of processes.
+            tasks (dict): The function and arguments of every task, indexed by a key. Functions return an error or None.
+            on_done (callable): Called with the key and the error, or None, of every finished task.
+        """
+        isolated = []
+        with self._pool(workers) as executor:
+            futures = {executor.submit(tasks[key][0], *tasks[key][1]): key for key in tasks}
+            for future in as_completed(futures):
+                key = futures[future]
+                try:
+                    error = future.result()
+                except BrokenProcessPool:
+                    isolated.append(key)
+                    continue
+                on_done(key, error)
+
+        # Up to workers single process pools run at once, so a crash is charged to the task that caused it only
+        attempts = dict.fromkeys(isolated, 0)
+        running = dict()
+        while len(isolated) > 0 or len(running) > 0:
+            while len(isolated) > 0 and len(running) < workers:
+                key = isolated.pop(0)
+                executor = self._pool(1)
+                running[executor.submit(tasks[key][0], *tasks[key][1])] = (key, executor)
+
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                key, executor = running.pop(future)
+                executor.shutdown()
+                attempts[key] += 1
+                try:
+                    error = future.result()
+                except BrokenProcessPool:
+                    if attempts[key] < Video.MAX_ATTEMPTS:
+                        isolated.append(key)
+                        continue
+                    error = "Worker process crashed"
+                on_done(key, error)
+
+    def _pool(self, workers):
+        """
+        Returns a pool of the given amount of processes, each initialized with the template of this video.
+        """
+        return ProcessPoolExecutor(max_workers=workers, initializer=_initWorker, initargs=(self.target_directory, self._settings()))
 
     def _parseRow(self, row):
         phase = self._parseInt(row, 'Phase')
@@ -116,7 +398,7 @@ class Video:
         dimensions = self._parseXY(row, 'Width', 'Height')
 
         if vtype == self.VType.OUTPUT:
-            self._parseOutput(phase, vtype, source, dimensions)
+            self._parseOutput(phase, vtype, source, dimensions, row)
         else:
             margins = self._parseXY(row, 'H Margin', 'V Margin')
             alignment = self._parseAlignment(row)
@@ -132,16 +414,30 @@ class Video:
             else:
                 print(f"Unrecognized type: \"{vtype}\". Skiping")
 
-    def _parseOutput(self, phase, vtype, source, dimensions):
+    def _parseOutput(self, phase, vtype, source, dimensions, row):
         print(f"Phase {phase}: Parsing Output.")
         if int(phase) != 0:
             raise ValueError(f"Output can only be a part of phase 0. Received {phase}. Skipping")
 
         print(f"\tAudio Source: \"{self.audio}\".")
         self.audio = join(self.template_directory, source) if len(source) > 0 else None
+        # Encoders need even dimensions, which scaled ones may not be
+        if self.scale != 1.0:
+            dimensions = tuple(max(2, int(value * self.scale) // 2 * 2) for value in dimensions)
         print(f"\tVideo Dimensions: {dimensions}.")
         self.dimensions = dimensions
 
+        # Optional encoder columns, empty ones keep the Sink defaults
+        encoder = dict(
+            codec = self._parseString(row, 'Codec'),
+            preset = self._parseString(row, 'Preset'),
+            crf = self._parseFloat(row, 'CRF'),
+            bit_rate = self._parseBitrate(row, 'Bitrate'),
+            gop = self._parseInt(row, 'GOP'),
+            pix_fmt = self._parseString(row, 'Pixel Format'),
+            threads = self._parseInt(row, 'Threads'))
+        self.encoder = {name: value for name, value in encoder.items() if value != None}
+
     def _parseGraphics(self, phase, source, dimensions, margins, duration, transparency, alignment, loop, row):
         print(f"Phase {phase}: Added Graphics.")
         print(f"\tTransparency: {transparency}")
@@ -151,12 +447,18 @@ class Video:
             raise ValueError(f"File \"{file}\" does not exist")
         print(f"\tGraphics Source: \"{file}\".")
 
+        chroma_color = self._parseChromaColor(row) if transparency == Blending.CHROMA_KEYING else None
+        if chroma_color != None:
+            print(f"\tChroma Key Saturation: {chroma_color}")
+
         dimensions = self._calculateDimensions(dimensions)
         source = SingleMediaSource(
                 file,
                 resolution = dimensions,
                 on_end_loop = loop,
-                blending = transparency
+                blending = transparency,
+                chroma_color = chroma_color,
+                frame_step = self.frame_step
         )
         source = self._parseAndAddEffect(row, source)
         self._addToPhase(phase, source, dimensions, margins, duration, transparency, alignment, loop)
@@ -165,7 +467,7 @@ class Video:
         print(f"Phase {phase}: Added Product Slideshow.")
 
         dimensions = self._calculateDimensions(dimensions) 
-        source = ImageSlideshowSource(None, dimensions, min_time=duration, on_end_loop=loop, blending=transparency)
+        source = ImageSlideshowSource(None, dimensions, target_fps=self.fps, min_time=duration, on_end_loop=loop, blending=transparency)
         source = self._parseAndAddEffect(row, source)
         self._addToPhase(phase, source, dimensions, margins, duration, transparency, alignment, loop)
 
@@ -201,6 +503,21 @@ class Video:
         except:
             return default
 
+    def _parseString(self, row, name, default=None):
+        value = row.get(name, None)
+        if value == None or len(value.strip()) == 0:
+            return default
+        return value.strip()
+
+    def _parseBitrate(self, row, name, default=None):
+        value = self._parseString(row, name)
+        if value == None:
+            return default
+        try:
+            return _bitrate(value)
+        except ValueError:
+            raise ValueError(f"Unknown {name} \"{value}\"")
+
     def _parseBool(self, row, name, default=None):
         if name not in row or len(row[name]) == 0:
             return default
@@ -241,6 +558,19 @@ class Video:
             print(f"Unrecognized transparency method: \"{transparency}\". Using Alpha Blending")
             return Blending.ALPHA
 
+    def _parseChromaColor(self, row):
+        # Optional column with the key as an RGB hex color, e.g. "#00FF00"
+        value = row.get('Chroma Key', None)
+        if value == None or len(value.strip()) == 0:
+            return None
+        value = value.strip().lstrip('#')
+        try:
+            rgb = [int(value[i:i+2], 16) for i in (0, 2, 4)]
+        except ValueError:
+            raise ValueError(f"Unknown Chroma Key \"{row['Chroma Key']}\"")
+        bgr = np.array([[rgb[::-1]]], np.uint8)
+        return int(cv2.cvtColor(bgr, cv2.COLOR_BGR2HSV)[0,0,1])
+
     def _parseAndAddEffect(self, row, source):
         effectValue = row['Effect'].lower().strip()
         if len(effectValue) == 0 or effectValue == 'none':
@@ -259,7 +589,8 @@ class Video:
             print(f"\t\tSpeed: {speed}")
             print(f"\t\tLoop: {loop}")
 
-            return StrobeSource(source, min_size, start_size, speed, direction, True, loop)
+            # The speed is per frame, so that the zoom lasts as long at any frame rate
+            return StrobeSource(source, min_size, start_size, speed * self.frame_step, direction, True, loop)
         else:
             raise ValueError(f"Unknown effect \"{effectValue}\"")
 
@@ -300,10 +631,14 @@ class Video:
 
     def _calculateDimensions(self, dimensions):
         return (
-                dimensions[0] if type(dimensions[0]) == int else int(dimensions[0] * self.dimensions[0]),
-                dimensions[1] if type(dimensions[1]) == int else int(dimensions[1] * self.dimensions[1])
+                self._scaled(dimensions[0]) if type(dimensions[0]) == int else int(dimensions[0] * self.dimensions[0]),
+                self._scaled(dimensions[1]) if type(dimensions[1]) == int else int(dimensions[1] * self.dimensions[1])
         )
 
+    def _scaled(self, value):
+        # Absolute sizes and margins follow the scale of the output, percentages already do
+        return value if self.scale == 1.0 else max(1, round(value * self.scale))
+
     def _calculateMargins(self, alignment, margins, size):
         # Calculate for Horizontal Centered (ignores Margins)
         if alignment[0] == self.HAlignment.CENTERED:
@@ -312,7 +647,7 @@ class Video:
         else:
             # Calculate Left Margin for absolute values and percentages
             if type(margins[0]) == int:
-                valX = margins[0]
+                valX = self._scaled(margins[0])
             else:
                 valX = int(float(margins[0] * self.dimensions[0]))
 
@@ -326,7 +661,7 @@ class Video:
         else:
             # Calculate Top Margin for absolute values and percentages
             if type(margins[1]) == int:
-                valY = margins[1]
+                valY = self._scaled(margins[1])
             else:
                 valY = int(float(margins[1] * self.dimensions[1]))
 
@@ -364,14 +699,92 @@ class Video:
         return products
 
 
+def _bitrate(value):
+    """
+    Returns the bits per second of a bitrate given as a number, optionally with a k or M suffix, e.g. "800k" or "2.5M".
+    Used for both the Bitrate column and the --bitrate option.
+    """
+    value = value.strip()
+    multiplier = {'k': 1000, 'm': 1000000}.get(value[-1:].lower(), 1)
+    return int(float(value[:-1] if multiplier > 1 else value) * multiplier)
+
+# State of each worker process when rendering in parallel
+_worker_video = None
+_worker_controller = None
+
+def _initWorker(target_directory, settings):
+    global _worker_video, _worker_controller
+    with redirect_stdout(io.StringIO()):
+        _worker_video = Video(target_directory, **settings)
+        _worker_controller = _worker_video._compose()
+
+def _renderProduct(product, files):
+    """
+    Renders a single product in a worker process.
+
+    Returns:
+        str: The error traceback if the product failed, None otherwise.
+    """
+    try:
+        _worker_video._render(_worker_controller, product, files)
+    except Exception:
+        return traceback.format_exc()
+    return None
+
+def _renderSegment(files, start, count, path):
+    """
+    Renders count frames of a product, starting at frame start, into a video file without audio in a worker process.
+
+    Returns:
+        str: The error traceback if the segment failed, None otherwise.
+    """
+    try:
+        controller = _worker_controller
+        controller.reset(files)
+        controller.seek(start)
+        sink = Sink(
+                source = controller,
+                target_fps = _worker_video.fps,
+                output_video_path = path,
+                frames = count,
+                batch_size = _worker_video.batch_size,
+                **_worker_video.encoder)
+        sink.create_video()
+    except Exception:
+        return traceback.format_exc()
+    return None
+
+
 if __name__ == "__main__":
-    # Test entry into program
-    if len(argv) < 2:
-        print(f"Usage: python {argv[0]} <target-directory>")
-        exit()
+    parser = argparse.ArgumentParser(description="Renders a video for every product of a target directory")
+    parser.add_argument("target_directory", help="Directory with the template.csv file, and the template, products and output folders")
+    parser.add_argument("--workers", type=int, default=1, help="Amount of processes rendering products in parallel. Default is 1")
+    parser.add_argument("--queue-depth", type=int, default=0, help="Frames queued between the render and encode threads, 0 to render and encode in one thread. Measure with benchmark.py before enabling it. Default is 0")
+    parser.add_argument("--split-phases", action="store_true", help="Render the phases of each video in parallel and join them without re-encoding")
+    parser.add_argument("--chunk-seconds", type=float, default=None, help="With --split-phases, also split phases longer than this many seconds. Rate control restarts with every segment, so size and quality differ from an unsplit render")
+    parser.add_argument("--prefetch", type=int, default=1, help="Upcoming products whose images are loaded in the background while rendering, 0 to disable. Default is 1")
+    parser.add_argument("--prefetch-memory", type=int, default=256, help="Memory budget in MB of the images loaded in the background. Default is 256")
+    parser.add_argument("--batch-size", type=int, default=1, help="Frames pulled from the sources at once, which pays the per frame overhead of nested sources once per batch. Default is 1")
+    parser.add_argument("--codec", default=None, help="FFmpeg video encoder, e.g. libx264. Overrides the Codec column of the OUTPUT row. Default is mpeg4")
+    parser.add_argument("--preset", default=None, help="Encoder preset trading speed against size, e.g. veryfast. Overrides the Preset column")
+    parser.add_argument("--crf", type=float, default=None, help="Constant rate factor for encoders supporting it, lower is better quality. Overrides the CRF column")
+    parser.add_argument("--bitrate", type=_bitrate, default=None, help="Target bitrate in bits per second, optionally with a k or M suffix, e.g. 800k or 2.5M. Overrides the Bitrate column")
+    parser.add_argument("--gop", type=int, default=None, help="Maximum frames between keyframes. Overrides the GOP column")
+    parser.add_argument("--pix-fmt", default=None, help="Pixel format of the encoded video. Overrides the Pixel Format column. Default is yuv420p")
+    parser.add_argument("--encoder-threads", type=int, default=None, help="Encoder threads, 0 to let the encoder choose. Overrides the Threads column")
+    parser.add_argument("--hold", choices=Sink.HOLD_MODES, default=None, help="How frames that repeat the previous one are written: resubmit encodes the converted frame again, vfr makes the previous frame last longer in a variable frame rate video, none converts and encodes them like any other frame. Default is resubmit")
+    parser.add_argument("--preview", action="store_true", help="Render a quick preview of the first products at a reduced size and frame rate into the preview folder")
+    parser.add_argument("--preview-scale", type=float, default=0.25, help="With --preview, the factor applied to every dimension. Default is 0.25")
+    parser.add_argument("--preview-fps", type=int, default=15, help="With --preview, the frame rate of the videos. Default is 15")
+    parser.add_argument("--preview-products", type=int, default=3, help="With --preview, the amount of products rendered. Default is 3")
+    parser.add_argument("--force", action="store_true", help="Render every product, even those whose output is up to date")
+    parser.add_argument("--dry-run", action="store_true", help="List the products that would be rendered without rendering them")
+    parser.add_argument("--profile", default=None, metavar="TRACE_PATH", help="Profile every source and the encoder, print a summary per source and write a Chrome trace of the batch to this path")
+    parser.add_argument("--profile-memory", action="store_true", help="With --profile, also track the peak bytes allocated by every source. Slows down rendering")
+    args = parser.parse_args()
 
     # Get target directory and validate it
-    target_directory = argv[1]
+    target_directory = args.target_directory
     if not exists(target_directory):
         print(f"Directory \"{target_directory}\" does not exist")
         exit()
@@ -379,6 +792,31 @@ if __name__ == "__main__":
         print(f"Path \"{target_directory}\" is not a directory")
         exit()
 
-    video = Video(target_directory)
-    video.create()
-
+    video = Video(
+            target_directory,
+            queue_depth=max(0, args.queue_depth),
+            prefetch_depth=max(0, args.prefetch),
+            prefetch_bytes=max(0, args.prefetch_memory) * 1024 * 1024,
+            encoder=dict(
+                codec=args.codec,
+                preset=args.preset,
+                crf=args.crf,
+                bit_rate=args.bitrate,
+                gop=args.gop,
+                pix_fmt=args.pix_fmt,
+                threads=args.encoder_threads,
+                hold=args.hold),
+            fps=max(1, args.preview_fps) if args.preview else template_fps,
+            scale=args.preview_scale if args.preview else 1.0,
+            max_products=args.preview_products if args.preview else None,
+            output_directory=join(target_directory, 'preview') if args.preview else None,
+            batch_size=max(1, args.batch_size))
+    profiler = Profiler(track_memory=args.profile_memory) if args.profile != None else None
+    failures = video.create(workers=max(1, args.workers), split_phases=args.split_phases, chunk_seconds=args.chunk_seconds, profiler=profiler, force=args.force, dry_run=args.dry_run)
+    if profiler != None:
+        print("Profile")
+        profiler.print_summary()
+        profiler.write_trace(args.profile)
+        print(f"\tTrace written to \"{args.profile}\"")
+    if len(failures) > 0:
+        exit(1)